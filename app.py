@@ -1,8 +1,21 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
+import csv
+import functools
+import io
 import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+import unicodedata
+import uuid
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager, nullcontext
 from datetime import datetime, timedelta
 import plotly.express as px
 from PIL import Image
@@ -46,93 +59,1967 @@ st.markdown("""
 
 NOME_FOLHA_GOOGLE = "dados_frota"
 
-# --- 2. LIGAÇÕES GOOGLE SHEETS ---
-def conectar_gsheets():
-    scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+# --- 2. INSTRUMENTAÇÃO ---
+LIMITE_SPANS = 5000  # medições guardadas em memória; as mais antigas vão saindo
+LIMITE_ERROS = 200
+SPAN_LENTO_MS = 2000  # medições mais lentas do que isto também vão para o log
+ESCRITAS_API = {"append_row", "append_rows", "update", "batch_update", "delete_rows", "add_worksheet"}
+log_frota = logging.getLogger("frota")
+
+class Telemetria:
+    """Tempos das funções de dados e das etapas de cada execução do script, pedidos à API do Google
+    (nº, bytes e ritmo no último minuto) e os erros que os except apanham em silêncio.
+    Partilhada por todo o processo; cada medição leva o número da execução que a fez."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()  # execução e etapa em curso, por fio
+        self.limpar()
+
+    def limpar(self):
+        with self.lock:
+            self.spans = deque(maxlen=LIMITE_SPANS)
+            self.erros = deque(maxlen=LIMITE_ERROS)
+            self.totais = {}  # nome -> [n, total_ms, max_ms]
+            self.pedidos = Counter()  # método da API -> nº de pedidos
+            self.bytes = Counter()  # "recebidos" / "enviados", aproximados
+            self.minuto = deque()  # (instante, é_escrita) dos pedidos dos últimos 60 s
+            self.desde = time.time()
+            self.n_execucoes = 0
+
+    def execucao(self):
+        return getattr(self.local, "execucao", None)
+
+    def nova_execucao(self):
+        """Início de uma execução do script neste fio; None = fios de fundo (diário, sincronização)."""
+        with self.lock:
+            self.n_execucoes += 1
+            self.local.execucao = self.n_execucoes
+        self.local.etapa = None
+        return self.local.execucao
+
+    def etapa(self, nome):
+        """Fecha a etapa anterior desta execução (ui.<nome>) e abre a seguinte; etapa(None) só fecha."""
+        agora = time.perf_counter()
+        anterior = getattr(self.local, "etapa", None)
+        if anterior: self.span("ui." + anterior[0], (agora - anterior[1]) * 1000)
+        self.local.etapa = (nome, agora) if nome else None
+
+    def span(self, nome, ms):
+        registo = {"tipo": "span", "hora": time.time(), "execucao": self.execucao(), "nome": nome, "ms": round(ms, 2)}
+        with self.lock:
+            self.spans.append(registo)
+            total = self.totais.setdefault(nome, [0, 0.0, 0.0])
+            total[0] += 1; total[1] += ms; total[2] = max(total[2], ms)
+        if ms > SPAN_LENTO_MS: log_frota.warning(json.dumps(registo, ensure_ascii=False))
+
+    def erro(self, onde, erro):
+        """Regista a exceção uma só vez, mesmo que passe por vários medir()/except até ser tratada."""
+        if getattr(erro, "_registado", False): return
+        try: erro._registado = True
+        except: pass
+        registo = {"tipo": "erro", "hora": time.time(), "execucao": self.execucao(), "onde": onde, "erro": type(erro).__name__, "mensagem": str(erro)[:500]}
+        with self.lock: self.erros.append(registo)
+        log_frota.error(json.dumps(registo, ensure_ascii=False))
+
+    def pedido(self, metodo, recebidos=0, enviados=0):
+        agora = time.time()
+        with self.lock:
+            self.pedidos[metodo] += 1
+            self.bytes["recebidos"] += recebidos
+            self.bytes["enviados"] += enviados
+            self.minuto.append((agora, metodo in ESCRITAS_API))
+            while self.minuto and self.minuto[0][0] < agora - 60: self.minuto.popleft()
+
+    def ritmo_minuto(self):
+        """(leituras, escritas) feitas ao Google nos últimos 60 segundos."""
+        agora = time.time()
+        with self.lock: recentes = [e for t, e in self.minuto if t >= agora - 60]
+        return len(recentes) - sum(recentes), sum(recentes)
+
+    def spans_da_execucao(self, execucao):
+        with self.lock: return [s for s in self.spans if s["execucao"] == execucao]
+
+    def tabela_totais(self):
+        with self.lock: linhas = [(nome, n, total / n, maximo) for nome, (n, total, maximo) in self.totais.items()]
+        return pd.DataFrame(linhas, columns=["Medição", "N", "Média (ms)", "Máx (ms)"]).sort_values("Média (ms)", ascending=False)
+
+    def exportar(self):
+        """Registo completo em JSON Lines: uma linha por medição e por erro, e uma final com os pedidos."""
+        with self.lock:
+            linhas = list(self.spans) + list(self.erros)
+            linhas.append({"tipo": "pedidos", "hora": time.time(), "desde": self.desde, "por_metodo": dict(self.pedidos), "bytes": dict(self.bytes)})
+        return "\n".join(json.dumps(l, ensure_ascii=False) for l in linhas) + "\n"
+
+@st.cache_resource(show_spinner=False)
+def obter_telemetria():
+    return Telemetria()
+
+@contextmanager
+def medir(nome):
+    """with medir("nome"): ... guarda o tempo do bloco; uma exceção fica registada (uma só vez) e segue."""
+    inicio = time.perf_counter()
+    try: yield
+    except Exception as e: obter_telemetria().erro(nome, e); raise
+    finally: obter_telemetria().span(nome, (time.perf_counter() - inicio) * 1000)
+
+def medido(nome):
+    """Decorador: cada chamada da função é medida com medir(nome)."""
+    def decorar(funcao):
+        @functools.wraps(funcao)
+        def medida(*args, **kwargs):
+            with medir(nome): return funcao(*args, **kwargs)
+        return medida
+    return decorar
+
+def _bytes_aprox(valor, amostra=200):
+    """Tamanho em JSON do que vai ou vem da API; nas tabelas grandes extrapola de uma amostra de linhas."""
     try:
-        if "service_account" in st.secrets:
-            creds_dict = st.secrets["service_account"]
-            if "gcp_json" in creds_dict:
-                try: creds_json = json.loads(creds_dict["gcp_json"], strict=False)
-                except: creds_json = json.loads(creds_dict["gcp_json"])
-            else: creds_json = creds_dict
-        else: return None
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_json, scope)
-        client = gspread.authorize(creds)
-        return client.open(NOME_FOLHA_GOOGLE)
-    except: return None
-
-# --- 3. FUNÇÕES DE DADOS (FATURAS) ---
-def carregar_dados():
-    wb = conectar_gsheets()
-    if wb:
+        if isinstance(valor, dict) and "valueRanges" in valor: return sum(_bytes_aprox(r.get("values", [])) for r in valor["valueRanges"])
+        if isinstance(valor, (list, tuple)) and len(valor) > amostra: return len(json.dumps(valor[:amostra], default=str)) * len(valor) // amostra
+        return len(json.dumps(valor, default=str))
+    except: return 0
+
+class ApiMedida:
+    """Cliente, livro ou folha do gspread em que cada método chamado conta como um pedido à API."""
+
+    def __init__(self, alvo):
+        self._alvo = alvo
+
+    def __getattr__(self, nome):
+        valor = getattr(self._alvo, nome)
+        if nome.startswith("_") or not callable(valor): return valor
+        def chamada(*args, **kwargs):
+            resultado = None
+            try:
+                with medir(f"api.{nome}"): resultado = valor(*args, **kwargs)
+                return resultado
+            finally:
+                escrita = nome in ESCRITAS_API
+                obter_telemetria().pedido(nome, recebidos=0 if escrita else _bytes_aprox(resultado), enviados=_bytes_aprox([args, kwargs]) if escrita else 0)
+        return chamada
+
+def painel_desempenho(execucao):
+    """Painel da barra lateral (só administradores): onde foi o tempo, pedidos ao Google e erros."""
+    tel = obter_telemetria()
+    with st.expander("🛠️ Desempenho"):
+        quota_l = int(ler_config("instrumentacao", "quota_leituras_minuto", 60))
+        quota_e = int(ler_config("instrumentacao", "quota_escritas_minuto", 60))
+        leituras, escritas = tel.ritmo_minuto()
+        st.caption(f"Google no último minuto: {leituras}/{quota_l} leituras · {escritas}/{quota_e} escritas")
+        if leituras >= 0.8 * quota_l or escritas >= 0.8 * quota_e: st.warning("⚠️ Perto do limite de pedidos por minuto do Google.")
+        st.caption(f"Desde {datetime.fromtimestamp(tel.desde):%d/%m %H:%M}: {sum(tel.pedidos.values())} pedidos · {tel.bytes['recebidos'] / 1e6:.1f} MB recebidos · {tel.bytes['enviados'] / 1e6:.2f} MB enviados")
+
+        spans = tel.spans_da_execucao(execucao)
+        if spans:
+            st.markdown(f"**Esta execução** ({sum(s['ms'] for s in spans if s['nome'].startswith('ui.')):.0f} ms)")
+            st.dataframe(pd.DataFrame(spans)[["nome", "ms"]], hide_index=True, use_container_width=True)
+        st.markdown("**Acumulado**")
+        st.dataframe(tel.tabela_totais().round(1), hide_index=True, use_container_width=True)
+        if tel.pedidos:
+            st.markdown("**Pedidos por método**")
+            st.dataframe(pd.DataFrame(tel.pedidos.most_common(), columns=["Método", "N"]), hide_index=True, use_container_width=True)
+        if tel.erros:
+            st.markdown(f"**Erros ({len(tel.erros)})**")
+            erros = pd.DataFrame(list(tel.erros)[-20:][::-1])
+            erros["hora"] = pd.to_datetime(erros["hora"], unit="s").dt.strftime("%H:%M:%S")
+            st.dataframe(erros[["hora", "onde", "erro", "mensagem"]], hide_index=True, use_container_width=True)
+
+        st.download_button("⬇️ Exportar Registo", tel.exportar(), file_name=f"desempenho_{datetime.now():%Y%m%d_%H%M}.jsonl", mime="application/json", use_container_width=True)
+        if st.button("🧹 Limpar Medições", use_container_width=True): tel.limpar(); st.rerun()
+
+# --- 3. LIGAÇÕES GOOGLE SHEETS ---
+SCOPE_GOOGLE = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+
+def ler_credenciais():
+    if "service_account" not in st.secrets: return None
+    creds_dict = st.secrets["service_account"]
+    if "gcp_json" in creds_dict:
+        try: return json.loads(creds_dict["gcp_json"], strict=False)
+        except: return json.loads(creds_dict["gcp_json"])
+    return dict(creds_dict)
+
+class LigacaoSheets:
+    """Ligação partilhada por todo o processo: cliente autorizado, livro e folhas já abertas.
+    Renova a autorização quando o token expira e volta a ligar depois de uma falha."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.creds = None
+        self.client = None
+        self.wb = None
+        self.folhas = {}
+
+    @medido("sheets.autorizar")
+    def _autorizar(self):
+        creds_json = ler_credenciais()
+        if creds_json is None: raise RuntimeError("Sem credenciais 'service_account' nos secrets.")
+        self.creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_json, SCOPE_GOOGLE)
+        self.client = ApiMedida(gspread.authorize(self.creds))
+        self.wb = ApiMedida(self.client.open(NOME_FOLHA_GOOGLE))
+        self.folhas = {}
+
+    def reiniciar(self):
+        with self.lock:
+            self.creds = self.client = self.wb = None
+            self.folhas = {}
+
+    def livro(self):
+        with self.lock:
+            if self.wb is None or getattr(self.creds, "access_token_expired", False): self._autorizar()
+            return self.wb
+
+    def folha(self, chave=0):
+        """Folha pelo índice (0 = faturas) ou pelo nome (ex.: "Validades"), aberta uma só vez."""
+        with self.lock:
+            wb = self.livro()
+            if chave not in self.folhas:
+                self.folhas[chave] = ApiMedida(wb.get_worksheet(chave) if isinstance(chave, int) else wb.worksheet(chave))
+            return self.folhas[chave]
+
+    def executar(self, operacao, tentativas=2):
+        """Corre operacao(ligacao); se falhar, desliga e tenta de novo com uma ligação nova.
+        Escritas que não se podem repetir sem risco (append, delete) usam tentativas=1."""
+        for tentativa in range(tentativas):
+            try: return operacao(self)
+            except Exception:
+                self.reiniciar()
+                if tentativa == tentativas - 1: raise
+
+@st.cache_resource(show_spinner=False)
+def obter_ligacao():
+    return LigacaoSheets()
+
+# --- 4. ARMAZENAMENTO ---
+COLUNAS_FATURAS = ["Data_Fatura", "Matricula", "Categoria", "Valor", "KM_Atuais", "Num_Fatura", "Descricao", "Litros", "Preco_Litro", "AdBlue", "ID_Fatura", "Versao"]
+N_COLUNAS_DADOS = COLUNAS_FATURAS.index("ID_Fatura")  # ID_Fatura e Versao não se escrevem à mão
+CATEGORIAS = ["Combustível", "Pneus", "Oficina", "Frio", "Lavagem", "Portagens", "Seguro", "Inspeção", "IUC"]
+COLUNAS_VALIDADES = ["Matricula", "Data_Seguro", "Data_Inspecao", "Data_IUC", "Observacoes"]
+PREFIXO_PARTICAO = "Faturas "  # folha de cada ano arquivado: "Faturas 2023"
+FOLHA_MANIFESTO = "Particoes"
+COLUNAS_MANIFESTO = ["Ano", "Folha", "Linhas", "Atualizado_Em"]
+INTERVALO_SINC_TOTAL = 1800  # de quanto em quanto tempo se descarrega tudo para apanhar edições de terceiros
+LOTE_DELTA = 2000  # linhas lidas por pedido na sincronização incremental
+COLUNAS_ANCORA = ["Matricula", "Categoria", "Num_Fatura", "ID_Fatura"]  # colunas de texto que o USER_ENTERED não reformata
+INTERVALO_SINC_SHEETS = 30  # segundos entre envios das alterações do SQLite para o Google Sheets
+BACKOFF_MAX = 300  # segundos, teto da espera entre tentativas quando o Google falha (quota, rede)
+
+@st.cache_resource(show_spinner=False)
+def _tipo_conflito():
+    # A mesma classe em todas as execuções do script: backends e fios criados numa execução
+    # anterior levantam-na e o except de uma execução nova tem de a reconhecer
+    class ConflitoFatura(Exception):
+        """A fatura foi alterada ou apagada por outra pessoa depois de a termos lido."""
+    return ConflitoFatura
+
+ConflitoFatura = _tipo_conflito()
+
+def novo_id_fatura():
+    # Começa por letra para o USER_ENTERED nunca o ler como número
+    return "f" + uuid.uuid4().hex[:11]
+
+def _num_versao(versao):
+    try: return int(float(str(versao).strip() or 0))
+    except: return 0
+
+def ler_config(seccao, chave, omissao=None):
+    try: return st.secrets[seccao][chave]
+    except: return omissao
+
+def _linha_texto(dados, n_colunas=None):
+    linha = [str(x) for x in dados]
+    return linha + [""] * ((n_colunas or len(linha)) - len(linha))
+
+def _data_iso(texto):
+    for formato in ("%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y"):
+        try: return datetime.strptime(str(texto).strip(), formato).strftime("%Y-%m-%d")
+        except: continue
+    return str(texto)
+
+def _intervalo_datas(ano, mes):
+    """Limites [início, fim) em texto ISO para filtrar Data_Fatura por ano e/ou mês."""
+    if mes: return f"{ano}-{mes:02d}-01", (f"{ano + 1}-01-01" if mes == 12 else f"{ano}-{mes + 1:02d}-01")
+    return f"{ano}-01-01", f"{ano + 1}-01-01"
+
+def _normalizar_faturas(data):
+    """Cabeçalho + linhas da folha -> DataFrame de texto com exatamente as COLUNAS_FATURAS."""
+    cabecalho = [str(c).strip() for c in data[0]]
+    linhas = [list(r) + [""] * (len(cabecalho) - len(r)) for r in data[1:]]
+    df = pd.DataFrame(linhas, columns=cabecalho).loc[:, lambda d: ~d.columns.duplicated()]
+    for c in COLUNAS_FATURAS:
+        if c not in df.columns: df[c] = ""
+    return df[COLUNAS_FATURAS]
+
+def _registos(valores):
+    """Valores de uma folha (cabeçalho + linhas) -> lista de dicionários, como o get_all_records."""
+    if not valores: return []
+    cabecalho = [str(c).strip() for c in valores[0]]
+    return [dict(zip(cabecalho, list(r) + [""] * (len(cabecalho) - len(r)))) for r in valores[1:]]
+
+def _ancora(linha, colunas):
+    linha = list(linha) + [""] * (len(colunas) - len(linha))
+    return tuple(str(linha[colunas.index(c)]).strip() for c in COLUNAS_ANCORA if c in colunas)
+
+class BackendSheets:
+    """Guarda tudo diretamente no Google Sheets: folha 0 com as faturas e folha "Validades"."""
+    nome = "sheets"
+
+    def __init__(self):
+        self.linhas_validades = {}  # Matricula -> linha da folha "Validades", confirmado antes de cada escrita
+
+    def ler_tudo(self):
+        return obter_ligacao().executar(lambda lig: lig.folha(0).get_all_values())
+
+    def _ler_delta(self, df):
+        """Lê só as linhas a seguir às que já temos, começando na última conhecida (âncora).
+        Devolve as linhas novas, ou None se a âncora não bate certo (linhas editadas ou apagadas)."""
+        colunas = list(df.columns)
+        linha_ancora = len(df) + 1  # linha da folha com a última fatura conhecida (1 = cabeçalho)
+        ancora_cache = _ancora(df.iloc[-1].tolist() if len(df) else colunas, colunas)
+        novas, inicio = [], linha_ancora
+        while True:
+            fim = inicio + LOTE_DELTA - 1
+            intervalo = f"A{inicio}:{gspread.utils.rowcol_to_a1(fim, len(colunas))}"
+            bloco = obter_ligacao().executar(lambda lig: lig.folha(0).get(intervalo))
+            if inicio == linha_ancora:
+                if not bloco or _ancora(bloco[0], colunas) != ancora_cache: return None
+                bloco = bloco[1:]
+            novas += [list(r) + [""] * (len(colunas) - len(r)) for r in bloco]
+            if len(bloco) < fim - inicio + (0 if inicio == linha_ancora else 1): return novas
+            inicio = fim + 1
+
+    def ler_mudancas(self, df, total, data=None):
+        """Ida ao Google de um refrescamento, sem a cache trancada (ver _trocar_cache): df = as faturas
+        que a cache tinha, total = já é hora da leitura completa, data = valores da folha já lidos
+        (ver ler_arranque). Sem eles tenta o delta e só depois lê tudo. Devolve aplicar(cache)."""
+        if data is None and df is not None and not total:
+            try: novas = self._ler_delta(df)
+            except Exception as e: obter_telemetria().erro("dados.delta", e); novas = None
+            # Linhas sem ID (escritas à mão na folha) obrigam à leitura completa, que lhes atribui um
+            i_id = list(df.columns).index("ID_Fatura")
+            if novas is not None and all(str(l[i_id]).strip() for l in novas):
+                def _acrescentar(cache):
+                    if novas: cache.acrescentar(novas)
+                    cache.confirmar()
+                return _acrescentar
+        if data is None: data = self.ler_tudo()
+        if data: self._completar_cabecalho(data[0])
+        novo = self._com_ids(_normalizar_faturas(data)) if data and len(data) > 1 else pd.DataFrame(columns=COLUNAS_FATURAS)
+        return lambda cache: cache.guardar(novo)
+
+    def _com_ids(self, df):
+        """Linhas sem ID_Fatura (escritas à mão na folha) recebem um. Volta a ler depois de gravar: se
+        alguém apagou uma linha entretanto, os IDs devolvidos são os da folha."""
+        faltam = df.index[df["ID_Fatura"].astype(str).str.strip() == ""]
+        if not len(faltam): return df
+        self.atribuir_ids([(int(p), novo_id_fatura()) for p in faltam])
+        return _normalizar_faturas(self.ler_tudo())
+
+    def _completar_cabecalho(self, cabecalho):
+        """Folhas antigas só têm as 7 primeiras colunas: acrescenta os nomes das novas (Litros...) uma vez."""
+        cabecalho = [str(c).strip() for c in cabecalho if str(c).strip()]
+        if cabecalho == COLUNAS_FATURAS[:len(cabecalho)] and len(cabecalho) < len(COLUNAS_FATURAS):
+            obter_ligacao().executar(lambda lig: lig.folha(0).update(f"A1:{gspread.utils.rowcol_to_a1(1, len(COLUNAS_FATURAS))}", [COLUNAS_FATURAS]))
+
+    def atribuir_ids(self, pares):
+        """pares = [(posicao, id_fatura)] para linhas antigas sem ID; posições seguidas vão num só intervalo."""
+        cabecalho = obter_ligacao().executar(lambda lig: lig.folha(0).row_values(1))
+        self._completar_cabecalho(cabecalho)
+        coluna, blocos = COLUNAS_FATURAS.index("ID_Fatura") + 1, []
+        for p, id_fatura in sorted(pares):
+            if blocos and blocos[-1][0] + len(blocos[-1][1]) == p: blocos[-1][1].append([id_fatura])
+            else: blocos.append((p, [[id_fatura]]))
+        pedidos = [{"range": f"{gspread.utils.rowcol_to_a1(p + 2, coluna)}:{gspread.utils.rowcol_to_a1(p + 1 + len(v), coluna)}", "values": v} for p, v in blocos]
+        obter_ligacao().executar(lambda lig: lig.folha(0).batch_update(pedidos))
+
+    def _localizar(self, pedidos):
+        """pedidos = [(id_fatura, versao_lida, posicao)] -> posição atual de cada fatura na folha.
+        Confirma primeiro na posição esperada (só as colunas ID_Fatura:Versao); se as linhas se mexeram,
+        procura o ID nessas duas colunas. ConflitoFatura se alguma desapareceu ou mudou de Versao."""
+        coluna = COLUNAS_FATURAS.index("ID_Fatura") + 1
+        intervalo = lambda p, fim=None: f"{gspread.utils.rowcol_to_a1(p + 2, coluna)}:{gspread.utils.rowcol_to_a1(fim or p + 2, coluna + 1)}"
+        blocos = obter_ligacao().executar(lambda lig: lig.folha(0).batch_get([intervalo(int(p)) for _, _, p in pedidos]))
+        atuais = {}
+        for (id_fatura, _, p), bloco in zip(pedidos, blocos):
+            linha = (list(bloco[0]) if bloco else []) + ["", ""]
+            if id_fatura and linha[0] == id_fatura: atuais[id_fatura] = (int(p), linha[1])
+        if len(atuais) < len(pedidos):
+            colunas = obter_ligacao().executar(lambda lig: lig.folha(0).get(intervalo(0, lig.folha(0).row_count)))
+            for p, linha in enumerate(colunas):
+                linha = list(linha) + ["", ""]
+                if linha[0] and linha[0] not in atuais: atuais[linha[0]] = (p, linha[1])
+        posicoes = []
+        for id_fatura, versao, _ in pedidos:
+            if not id_fatura or id_fatura not in atuais: raise ConflitoFatura(f"A fatura {id_fatura} já não existe na folha.")
+            if _num_versao(atuais[id_fatura][1]) != _num_versao(versao): raise ConflitoFatura(f"A fatura {id_fatura} foi alterada por outra pessoa.")
+            posicoes.append(atuais[id_fatura][0])
+        return posicoes
+
+    def inserir_faturas(self, linhas):
+        """Todas as linhas num só append_rows: ou entram todas ou nenhuma."""
+        obter_ligacao().executar(lambda lig: lig.folha(0).append_rows([list(l) for l in linhas], value_input_option='USER_ENTERED'), tentativas=1)
+
+    def editar_faturas(self, alteracoes):
+        """alteracoes = [(id_fatura, versao_lida, posicao, dados), ...] num único batch_update, depois de
+        confirmar que nenhuma mudou desde que foi lida. Cada linha editada sobe uma Versao."""
+        posicoes = self._localizar([a[:3] for a in alteracoes])
+        coluna_versao = COLUNAS_FATURAS.index("Versao") + 1
+        pedidos = []
+        for p, (_, versao, _, dados) in zip(posicoes, alteracoes):
+            pedidos.append({"range": f"A{p + 2}:{gspread.utils.rowcol_to_a1(p + 2, len(dados))}", "values": [list(dados)]})
+            pedidos.append({"range": gspread.utils.rowcol_to_a1(p + 2, coluna_versao), "values": [[str(_num_versao(versao) + 1)]]})
+        obter_ligacao().executar(lambda lig: lig.folha(0).batch_update(pedidos))
+
+    def ids_na_folha(self):
+        coluna = COLUNAS_FATURAS.index("ID_Fatura") + 1
+        return set(obter_ligacao().executar(lambda lig: lig.folha(0).col_values(coluna))[1:]) - {""}
+
+    def linhas_por_id(self, ids):
+        """ID_Fatura -> linha atual na folha, só para os ids pedidos que lá estão (a coluna dos IDs e
+        depois essas linhas num batch_get)."""
+        coluna = COLUNAS_FATURAS.index("ID_Fatura") + 1
+        na_folha = obter_ligacao().executar(lambda lig: lig.folha(0).col_values(coluna))
+        linhas = {i: p + 1 for p, i in enumerate(na_folha) if p and i in ids}
+        if not linhas: return {}
+        ultima = gspread.utils.rowcol_to_a1(1, len(COLUNAS_FATURAS)).rstrip("1")
+        blocos = obter_ligacao().executar(lambda lig: lig.folha(0).batch_get([f"A{n}:{ultima}{n}" for n in linhas.values()]))
+        return {i: _linha_texto(bloco[0] if bloco else [], len(COLUNAS_FATURAS)) for i, bloco in zip(linhas, blocos)}
+
+    def substituir_faturas(self, linhas):
+        """A folha de faturas passa a ter exatamente estas linhas (o SQLite usa-o depois de um conflito)."""
+        valores = [COLUNAS_FATURAS] + [_linha_texto(l, len(COLUNAS_FATURAS)) for l in linhas]
+        def _reescrever(lig):
+            antigas = len(lig.folha(0).get_all_values())
+            lig.folha(0).update(range_name=f"A1:{gspread.utils.rowcol_to_a1(len(valores), len(COLUNAS_FATURAS))}", values=valores, value_input_option='USER_ENTERED')
+            if antigas > len(valores): lig.folha(0).delete_rows(len(valores) + 1, antigas)
+        obter_ligacao().executar(_reescrever, tentativas=1)
+
+    def eliminar_fatura(self, id_fatura, versao, posicao):
+        p = self._localizar([(id_fatura, versao, posicao)])[0]
+        obter_ligacao().executar(lambda lig: lig.folha(0).delete_rows(p + 2), tentativas=1)
+
+    def _indexar_validades(self, registos):
+        indice = {}
+        for i, r in enumerate(registos): indice.setdefault(str(r.get("Matricula", "")).strip(), i + 2)
+        self.linhas_validades = indice
+
+    def ler_validades(self):
+        registos = obter_ligacao().executar(lambda lig: lig.folha("Validades").get_all_records())
+        self._indexar_validades(registos)
+        return registos
+
+    def ler_arranque(self):
+        """Faturas (todas as linhas) e Validades (registos) no mesmo pedido, com values_batch_get."""
+        def _ler(lig):
+            titulo = lig.folha(0).title.replace("'", "''")
+            return lig.livro().values_batch_get([f"'{titulo}'", "Validades"])["valueRanges"]
+        faturas, validades = obter_ligacao().executar(_ler)
+        validades = _registos(validades.get("values", []))
+        self._indexar_validades(validades)
+        return faturas.get("values", []), validades
+
+    def _linhas_validades(self, matriculas):
+        """Matricula -> linha da folha. O índice em cache confirma-se lendo só as células da coluna A
+        dessas linhas; se alguma não bate certo (ou a matrícula é nova), relê-se a coluna A inteira.
+        Nunca o sheet.find, que também encontrava a matrícula escrita nas Observações."""
+        indice = self.linhas_validades
+        if all(m in indice for m in matriculas):
+            blocos = obter_ligacao().executar(lambda lig: lig.folha("Validades").batch_get([f"A{indice[m]}" for m in matriculas]))
+            if all(b and b[0] and str(b[0][0]).strip() == m for m, b in zip(matriculas, blocos)): return indice
+        coluna = obter_ligacao().executar(lambda lig: lig.folha("Validades").col_values(1))
+        self._indexar_validades([{"Matricula": m} for m in coluna[1:]])
+        return self.linhas_validades
+
+    def guardar_validades(self, linhas):
+        """Várias viaturas de uma vez: as que já têm linha num só batch_update (B:E), as novas num só append_rows."""
+        linhas = [_linha_texto(d, len(COLUNAS_VALIDADES))[:len(COLUNAS_VALIDADES)] for d in linhas]
+        linhas = list({l[0].strip(): [l[0].strip()] + l[1:] for l in linhas}.values())
+        indice = self._linhas_validades([l[0] for l in linhas])
+        pedidos = [{"range": f"B{indice[l[0]]}:E{indice[l[0]]}", "values": [l[1:]]} for l in linhas if l[0] in indice]
+        novas = [l for l in linhas if l[0] not in indice]
+        if pedidos: obter_ligacao().executar(lambda lig: lig.folha("Validades").batch_update(pedidos))
+        if novas:
+            self.linhas_validades = {}  # a posição das linhas acrescentadas só se sabe relendo a coluna
+            obter_ligacao().executar(lambda lig: lig.folha("Validades").append_rows(novas), tentativas=1)
+
+    def guardar_validade(self, dados): self.guardar_validades([dados])
+
+    def _titulos(self, lig):
+        return {f.title for f in lig.livro().worksheets()}
+
+    def ler_manifesto(self):
+        """Registos da folha FOLHA_MANIFESTO (um por ano arquivado); [] enquanto não há arquivo."""
+        return obter_ligacao().executar(lambda lig: lig.folha(FOLHA_MANIFESTO).get_all_records() if FOLHA_MANIFESTO in self._titulos(lig) else [])
+
+    def ler_numeros_arquivo(self, folhas):
+        """Nº de fatura -> ID_Fatura das linhas com esse Nº em todas as folhas arquivadas; só essas duas
+        colunas, num só pedido."""
+        if not folhas: return {}
+        colunas = [gspread.utils.rowcol_to_a1(1, COLUNAS_FATURAS.index(c) + 1).rstrip("1") for c in ("Num_Fatura", "ID_Fatura")]
+        titulos = [f.replace("'", "''") for f in folhas]
+        intervalos = [f"'{t}'!{c}2:{c}" for t in titulos for c in colunas]
+        blocos = obter_ligacao().executar(lambda lig: lig.livro().values_batch_get(intervalos)["valueRanges"])
+        numeros = {}
+        for bloco_nf, bloco_id in zip(blocos[::2], blocos[1::2]):
+            ids = bloco_id.get("values", [])
+            for k, l in enumerate(bloco_nf.get("values", [])):
+                nf = str(l[0]).strip() if l else ""
+                if nf: numeros.setdefault(nf, []).append(str(ids[k][0]).strip() if k < len(ids) and ids[k] else "")
+        return numeros
+
+    def ler_particao(self, folha):
+        return obter_ligacao().executar(lambda lig: lig.folha(folha).get_all_values())
+
+    def _gravar_manifesto(self, manifesto):
+        linhas = [COLUNAS_MANIFESTO] + [[str(manifesto[a].get(c, "")) for c in COLUNAS_MANIFESTO] for a in sorted(manifesto)]
+        def _gravar(lig):
+            if FOLHA_MANIFESTO not in self._titulos(lig): lig.livro().add_worksheet(title=FOLHA_MANIFESTO, rows=50, cols=len(COLUNAS_MANIFESTO))
+            lig.folha(FOLHA_MANIFESTO).update(range_name="A1", values=linhas)
+        obter_ligacao().executar(_gravar)
+
+    def arquivar_anos(self, ano_limite):
+        """Passa as faturas dos anos anteriores a ano_limite da folha 0 para uma folha por ano e
+        atualiza o manifesto; devolve os anos movidos. Pode repetir-se depois de uma falha: na folha do
+        ano não se copia outra vez o que já lá está (pelo ID_Fatura; com outra Versao é atualizado) e
+        na folha 0 só se apagam as linhas cujo ID_Fatura e Versao ainda são os que foram copiados.
+        O que outra instância alterar entretanto fica na folha 0 (e é essa a versão que se mostra)."""
+        # Sem ID não se sabe depois que linha da folha 0 foi copiada: primeiro dá-se um a cada uma
+        df = self._com_ids(_normalizar_faturas(self.ler_tudo()))
+        anos = pd.to_datetime(df["Data_Fatura"], errors="coerce").dt.year
+        mover = (anos < ano_limite) & (df["ID_Fatura"].astype(str).str.strip() != "")
+        if not mover.any(): return []
+        lig = obter_ligacao()
+        manifesto = {int(float(r["Ano"])): r for r in self.ler_manifesto() if str(r.get("Ano", "")).strip()}
+        i_id = COLUNAS_FATURAS.index("ID_Fatura")
+        intervalo_ids = f"{gspread.utils.rowcol_to_a1(2, i_id + 1)}:{gspread.utils.rowcol_to_a1(1, i_id + 2).rstrip('1')}"  # ID_Fatura:Versao
+        for ano, grupo in df[mover].groupby(anos[mover].astype(int)):
+            nome = f"{PREFIXO_PARTICAO}{ano}"
+            def _copiar(lig):
+                if nome not in self._titulos(lig):
+                    lig.livro().add_worksheet(title=nome, rows=len(grupo) + 1, cols=len(COLUNAS_FATURAS))
+                    lig.folha(nome).update(range_name="A1", values=[COLUNAS_FATURAS])
+                copiados = {l[0]: (p + 2, l[1] if len(l) > 1 else "") for p, l in enumerate(lig.folha(nome).get(intervalo_ids)) if l and l[0]}
+                linhas = grupo.values.tolist()
+                novas = [l for l in linhas if l[i_id] not in copiados]
+                mudadas = [{"range": f"A{copiados[l[i_id]][0]}:{gspread.utils.rowcol_to_a1(copiados[l[i_id]][0], len(COLUNAS_FATURAS))}", "values": [l]}
+                           for l in linhas if l[i_id] in copiados and _num_versao(copiados[l[i_id]][1]) != _num_versao(l[i_id + 1])]
+                if mudadas: lig.folha(nome).batch_update(mudadas, value_input_option='USER_ENTERED')
+                if novas: lig.folha(nome).append_rows(novas, value_input_option='USER_ENTERED')
+                return len(copiados) + len(novas)
+            linhas = lig.executar(_copiar, tentativas=1)
+            manifesto[int(ano)] = {"Ano": int(ano), "Folha": nome, "Linhas": linhas, "Atualizado_Em": datetime.now().strftime("%Y-%m-%d %H:%M")}
+        self._gravar_manifesto(manifesto)
+        copiadas = dict(zip(df.loc[mover, "ID_Fatura"], df.loc[mover, "Versao"]))
+        def _encolher(lig):
+            atuais = lig.folha(0).get(intervalo_ids)
+            posicoes = [p for p, l in enumerate(atuais) if l and l[0] in copiadas and _num_versao(l[1] if len(l) > 1 else "") == _num_versao(copiadas[l[0]])]
+            blocos = []
+            for p in posicoes:
+                if blocos and blocos[-1][1] == p - 1: blocos[-1][1] = p
+                else: blocos.append([p, p])
+            # De baixo para cima: apagar um bloco não mexe nas linhas dos blocos de cima
+            for inicio, fim in reversed(blocos): lig.folha(0).delete_rows(inicio + 2, fim + 2)
+        lig.executar(_encolher, tentativas=1)
+        return sorted(set(anos[mover].astype(int)))
+
+SQL_VERSAO = "CAST(CASE WHEN Versao = '' THEN '0' ELSE Versao END AS INTEGER)"
+
+class BackendSQLite:
+    """Base de dados local (SQLite) com índices, usada como fonte principal. O Google Sheets passa a
+    ser um destino de sincronização: cada escrita deixa a operação na tabela sinc_sheets, que um
+    fio em segundo plano replica pela mesma ordem. Com sincronizar=False funciona sem rede."""
+    nome = "sqlite"
+
+    def __init__(self, caminho, sincronizar=True):
+        self.lock = threading.RLock()
+        self.sincronizar = sincronizar
+        self.con = sqlite3.connect(caminho, check_same_thread=False)
+        self.data_version = None
+        self.pendente = threading.Event()  # acorda o fio de sincronização logo após uma escrita
+        colunas_f = ", ".join(f"{c} TEXT NOT NULL DEFAULT ''" for c in COLUNAS_FATURAS)
+        colunas_v = ", ".join(f"{c} TEXT NOT NULL DEFAULT ''" for c in COLUNAS_VALIDADES[1:])
+        with self.con:
+            self.con.executescript(f"""
+                CREATE TABLE IF NOT EXISTS faturas (id INTEGER PRIMARY KEY AUTOINCREMENT, {colunas_f});
+                CREATE INDEX IF NOT EXISTS idx_faturas_num ON faturas (Num_Fatura);
+                CREATE INDEX IF NOT EXISTS idx_faturas_matricula ON faturas (Matricula, Data_Fatura);
+                CREATE INDEX IF NOT EXISTS idx_faturas_data ON faturas (Data_Fatura);
+                CREATE INDEX IF NOT EXISTS idx_faturas_categoria ON faturas (Categoria, Data_Fatura);
+                CREATE TABLE IF NOT EXISTS validades (Matricula TEXT PRIMARY KEY, {colunas_v});
+                CREATE TABLE IF NOT EXISTS sinc_sheets (id INTEGER PRIMARY KEY AUTOINCREMENT, operacao TEXT NOT NULL, argumentos TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS meta (chave TEXT PRIMARY KEY, valor TEXT NOT NULL);
+            """)
+            existentes = {r[1] for r in self.con.execute("PRAGMA table_info(faturas)")}
+            for c in COLUNAS_FATURAS:
+                if c not in existentes: self.con.execute(f"ALTER TABLE faturas ADD COLUMN {c} TEXT NOT NULL DEFAULT ''")
+            self.con.execute("CREATE INDEX IF NOT EXISTS idx_faturas_id ON faturas (ID_Fatura)")
+        self._atribuir_ids()
+
+    def _meta(self, chave):
+        row = self.con.execute("SELECT valor FROM meta WHERE chave = ?", (chave,)).fetchone()
+        return row[0] if row else None
+
+    def _registar_sinc(self, operacao, *argumentos):
+        if self.sincronizar:
+            self.con.execute("INSERT INTO sinc_sheets (operacao, argumentos) VALUES (?, ?)", (operacao, json.dumps(argumentos)))
+            self.pendente.set()
+
+    def _ler_df(self, where="", parametros=()):
+        with self.lock:
+            linhas = self.con.execute(f"SELECT {', '.join(COLUNAS_FATURAS)} FROM faturas {where} ORDER BY id", parametros).fetchall()
+        return pd.DataFrame(linhas, columns=COLUNAS_FATURAS)
+
+    def _atribuir_ids(self):
+        """Faturas antigas sem ID_Fatura recebem um; o Sheets recebe os mesmos pela fila de sincronização."""
+        with self.lock, self.con:
+            linhas = self.con.execute("SELECT id, ID_Fatura FROM faturas ORDER BY id").fetchall()
+            pares = [(p, novo_id_fatura()) for p, (_, id_fatura) in enumerate(linhas) if not id_fatura]
+            if not pares: return
+            self.con.executemany("UPDATE faturas SET ID_Fatura = ? WHERE id = ?", [(id_fatura, linhas[p][0]) for p, id_fatura in pares])
+            self._registar_sinc("atribuir_ids", pares)
+
+    def importar_de_sheets(self, origem):
+        """Primeira utilização: copia para o SQLite o que já está no Google Sheets, pela mesma ordem.
+        Se a aplicação arrancou sem rede e já se gravaram faturas locais, estas passam para depois
+        das importadas, que é onde a fila de sincronização as vai acrescentar na folha; nas Validades
+        ganha a versão local, que também já está na fila."""
+        with self.lock:
+            if self._meta("importado_sheets"): return
+        data = origem.ler_tudo()
+        validades = origem.ler_validades()
+        cabecalho = data[0] if data else COLUNAS_FATURAS
+        linhas = []
+        for r in data[1:]:
+            r = dict(zip(cabecalho, list(r) + [""] * (len(cabecalho) - len(r))))
+            linha = [str(r.get(c, "")) for c in COLUNAS_FATURAS]
+            linha[0] = _data_iso(linha[0])
+            linhas.append(linha)
+        inserir = f"INSERT INTO faturas ({', '.join(COLUNAS_FATURAS)}) VALUES ({', '.join('?' * len(COLUNAS_FATURAS))})"
+        with self.lock:
+            if self._meta("importado_sheets"): return
+            with self.con:
+                locais = self.con.execute(f"SELECT {', '.join(COLUNAS_FATURAS)} FROM faturas ORDER BY id").fetchall()
+                if locais: self.con.execute("DELETE FROM faturas")
+                self.con.executemany(inserir, linhas + [list(l) for l in locais])
+                self.con.executemany(f"INSERT OR IGNORE INTO validades VALUES ({', '.join('?' * len(COLUNAS_VALIDADES))})",
+                                     [[str(v.get(c, "")) for c in COLUNAS_VALIDADES] for v in validades if v.get("Matricula")])
+                self.con.execute("INSERT OR REPLACE INTO meta VALUES ('importado_sheets', ?)", (datetime.now().isoformat(),))
+            self.data_version = None  # escrito por esta ligação: o PRAGMA data_version não dá por isso
+        self._atribuir_ids()
+
+    def ler_mudancas(self, df, total, data=None):
+        # O data_version só muda quando outra ligação grava; as nossas escritas já atualizaram a cache.
+        # Só passa a ser o visto quando a leitura entra mesmo na cache (ver _trocar_cache).
+        with self.lock:
+            versao = self.con.execute("PRAGMA data_version").fetchone()[0]
+            if df is not None and versao == self.data_version: return CacheFaturas.confirmar
+            novo = self._ler_df()
+        def _guardar(cache):
+            cache.guardar(novo)
+            self.data_version = versao
+        return _guardar
+
+    def inserir_faturas(self, linhas):
+        linhas = [_linha_texto(l, len(COLUNAS_FATURAS)) for l in linhas]
+        with self.lock, self.con:
+            self.con.executemany(f"INSERT INTO faturas ({', '.join(COLUNAS_FATURAS)}) VALUES ({', '.join('?' * len(COLUNAS_FATURAS))})", linhas)
+            self._registar_sinc("inserir_faturas", linhas)
+
+    def editar_faturas(self, alteracoes):
+        """Como no Sheets, só se mexe nas colunas que vêm em dados (as restantes ficam como estão).
+        A Versao confirma-se no próprio UPDATE: se outra ligação mexeu na fatura, nada muda (ConflitoFatura)."""
+        alteracoes = [(id_fatura, _num_versao(versao), int(posicao), _linha_texto(dados)) for id_fatura, versao, posicao, dados in alteracoes]
+        with self.lock, self.con:
+            for id_fatura, versao, _, linha in alteracoes:
+                cur = self.con.execute(f"UPDATE faturas SET {', '.join(c + ' = ?' for c in COLUNAS_FATURAS[:len(linha)])}, Versao = ? WHERE ID_Fatura = ? AND {SQL_VERSAO} = ?",
+                                       linha + [str(versao + 1), id_fatura, versao])
+                if cur.rowcount != 1: raise ConflitoFatura(f"A fatura {id_fatura} foi alterada ou apagada por outra pessoa.")
+            self._registar_sinc("editar_faturas", alteracoes)
+
+    def eliminar_fatura(self, id_fatura, versao, posicao):
+        with self.lock, self.con:
+            cur = self.con.execute(f"DELETE FROM faturas WHERE ID_Fatura = ? AND {SQL_VERSAO} = ?", (id_fatura, _num_versao(versao)))
+            if cur.rowcount != 1: raise ConflitoFatura(f"A fatura {id_fatura} foi alterada ou apagada por outra pessoa.")
+            self._registar_sinc("eliminar_fatura", id_fatura, _num_versao(versao), int(posicao))
+
+    def consultar_ids(self, matriculas=(), ano=None, mes=None, categorias=()):
+        """ID_Fatura das faturas que respeitam os filtros, pela ordem da base; só se leem as linhas
+        que os índices de Matricula, Data_Fatura e Categoria apontam."""
+        condicoes, parametros = [], []
+        if matriculas: condicoes.append(f"Matricula IN ({', '.join('?' * len(matriculas))})"); parametros += list(matriculas)
+        if categorias: condicoes.append(f"Categoria IN ({', '.join('?' * len(categorias))})"); parametros += list(categorias)
+        if ano is not None:
+            condicoes.append("Data_Fatura >= ? AND Data_Fatura < ?"); parametros += list(_intervalo_datas(int(ano), mes))
+        elif mes is not None:
+            condicoes.append("substr(Data_Fatura, 6, 2) = ?"); parametros.append(f"{int(mes):02d}")
+        where = ("WHERE " + " AND ".join(condicoes)) if condicoes else ""
+        with self.lock: return [r[0] for r in self.con.execute(f"SELECT ID_Fatura FROM faturas {where} ORDER BY id", parametros)]
+
+    def ler_validades(self):
+        with self.lock:
+            linhas = self.con.execute(f"SELECT {', '.join(COLUNAS_VALIDADES)} FROM validades").fetchall()
+        return [dict(zip(COLUNAS_VALIDADES, r)) for r in linhas]
+
+    def guardar_validades(self, linhas):
+        linhas = [_linha_texto(d, len(COLUNAS_VALIDADES))[:len(COLUNAS_VALIDADES)] for d in linhas]
+        with self.lock, self.con:
+            self.con.executemany(f"INSERT OR REPLACE INTO validades VALUES ({', '.join('?' * len(COLUNAS_VALIDADES))})", linhas)
+            self._registar_sinc("guardar_validades", linhas)
+
+    def guardar_validade(self, dados): self.guardar_validades([dados])
+
+    def ler_manifesto(self): return []  # sem partições: os anos antigos já se leem pelo índice de Data_Fatura
+
+    def pendentes_sinc(self):
+        with self.lock: return self.con.execute("SELECT COUNT(*) FROM sinc_sheets").fetchone()[0]
+
+    def conflitos_sinc(self):
+        """(operações que a folha recusou desde a última reescrita, mensagem do último conflito)."""
+        with self.lock: return int(self._meta("ressincronizar") or 0), self._meta("ultimo_conflito_sinc") or ""
+
+    def sincronizar_sheets(self, destino, limite=200):
+        """Replica no destino as operações pendentes, pela ordem em que foram feitas.
+        Inserções seguidas vão juntas num só append_rows. Pára na primeira falha para não trocar
+        a ordem; o que falhou fica para a próxima volta e, como pode ter chegado à folha (timeout
+        depois de o Google a aplicar), repete-se só o que lá falta (_por_repetir). Se a folha recusar
+        uma operação (alguém mexeu nela fora da aplicação), o SQLite é que manda: a folha é reescrita a partir dele."""
+        with self.lock:
+            reescrever = self._meta("ressincronizar") is not None
+            operacoes = [] if reescrever else self.con.execute("SELECT id, operacao, argumentos FROM sinc_sheets ORDER BY id LIMIT ?", (limite,)).fetchall()
+            em_envio = set(json.loads(self._meta("sinc_em_envio") or "[]"))  # ids da operação que estava a ser enviada quando falhou
+        for ids, operacao, argumentos in _agrupar_operacoes(operacoes):
+            try:
+                if em_envio & set(ids): argumentos = _por_repetir(destino, operacao, argumentos)
+                else:
+                    with self.lock, self.con: self.con.execute("INSERT OR REPLACE INTO meta VALUES ('sinc_em_envio', ?)", (json.dumps(ids),))
+                if argumentos is not None: getattr(destino, operacao)(*argumentos)
+            except ConflitoFatura as e:
+                obter_telemetria().erro("sinc_sheets.conflito", e)
+                with self.lock, self.con:
+                    self.con.execute("INSERT OR REPLACE INTO meta VALUES ('ultimo_conflito_sinc', ?)", (str(e),))
+                    self.con.execute("INSERT OR REPLACE INTO meta VALUES ('ressincronizar', ?)", (str(int(self._meta("ressincronizar") or 0) + len(ids)),))
+                reescrever = True
+                break
+            with self.lock, self.con:
+                self.con.executemany("DELETE FROM sinc_sheets WHERE id = ?", [(i,) for i in ids])
+                self.con.execute("DELETE FROM meta WHERE chave = 'sinc_em_envio'")
+        if reescrever: self._reescrever_sheets(destino)
+        return len(operacoes)
+
+    def _reescrever_sheets(self, destino):
+        """A folha de faturas passa a ser uma cópia da base. As escritas de faturas ainda na fila já estão
+        nessa cópia e saem da fila na mesma transação; se o envio falhar, a próxima volta tira outra cópia."""
+        with self.lock, self.con:
+            linhas = [list(l) for l in self.con.execute(f"SELECT {', '.join(COLUNAS_FATURAS)} FROM faturas ORDER BY id").fetchall()]
+            self.con.execute("DELETE FROM sinc_sheets WHERE operacao != 'guardar_validades'")
+        destino.substituir_faturas(linhas)
+        with self.lock, self.con: self.con.execute("DELETE FROM meta WHERE chave = 'ressincronizar'")
+
+def _agrupar_operacoes(operacoes):
+    """[(id, operacao, argumentos_json)] -> [(ids, operacao, argumentos)], juntando inserções seguidas num só lote."""
+    grupos = []
+    for id_op, operacao, argumentos in operacoes:
+        argumentos = json.loads(argumentos)
+        if operacao == "inserir_fatura": operacao, argumentos = "inserir_faturas", [[argumentos[0]]]
+        if operacao == "inserir_faturas" and grupos and grupos[-1][1] == "inserir_faturas":
+            grupos[-1][0].append(id_op); grupos[-1][2][0].extend(argumentos[0])
+        else: grupos.append(([id_op], operacao, argumentos))
+    return grupos
+
+def _espera_backoff(falhas):
+    """Espera exponencial (2, 4, 8... s, até BACKOFF_MAX) com um pouco de aleatoriedade."""
+    return min(2 ** falhas, BACKOFF_MAX) * random.uniform(0.5, 1.0)
+
+def _ciclo_sinc_sheets(backend):
+    destino, falhas = BackendSheets(), 0
+    while True:
         try:
-            sheet = wb.get_worksheet(0)
-            data = sheet.get_all_values()
-            if not data or len(data) <= 1: 
-                return pd.DataFrame(columns=["Data_Fatura", "Matricula", "Categoria", "Valor", "KM_Atuais", "Num_Fatura", "Descricao"])
-            df = pd.DataFrame(data[1:], columns=data[0])
-            return df
-        except: return pd.DataFrame()
-    return pd.DataFrame()
-
-def guardar_registo(dados):
-    wb = conectar_gsheets()
-    if wb:
-        try: 
-            wb.get_worksheet(0).append_row(dados, value_input_option='USER_ENTERED')
-            return True
-        except: return False
-    return False
-
-def eliminar_registo(indice):
-    wb = conectar_gsheets()
-    if wb:
-        try: wb.get_worksheet(0).delete_rows(indice + 2); return True
-        except: return False
-    return False
-
-def editar_registo(indice, novos_dados):
-    wb = conectar_gsheets()
-    if wb:
-        try: 
-            linha = indice + 2
-            wb.get_worksheet(0).update(f"A{linha}:G{linha}", [novos_dados])
-            return True
-        except: return False
-    return False
-
-# --- 4. FUNÇÕES DE DADOS (VALIDADES) ---
-def carregar_validades():
-    wb = conectar_gsheets()
-    if wb:
+            # Enquanto a importação inicial não se fez, enviar duplicaria na folha as faturas locais
+            backend.importar_de_sheets(destino)
+            backend.sincronizar_sheets(destino); falhas = 0
+        except Exception as e:
+            falhas += 1
+            obter_telemetria().erro("sinc_sheets", e)
+        if falhas: time.sleep(_espera_backoff(falhas)); continue
+        backend.pendente.wait(INTERVALO_SINC_SHEETS)
+        backend.pendente.clear()
+
+@st.cache_resource(show_spinner=False)
+def obter_backend():
+    """Backend escolhido em [armazenamento] nos secrets (backend = "sheets" | "sqlite"). Por omissão é o Sheets."""
+    if ler_config("armazenamento", "backend", "sheets") != "sqlite": return BackendSheets()
+    backend = BackendSQLite(ler_config("armazenamento", "caminho_sqlite", "frota.db"), sincronizar=bool(ler_config("armazenamento", "sincronizar_sheets", True)))
+    if backend.sincronizar:
+        # Sem rede (ou sem credenciais) arranca só com a base local; o fio de sincronização volta a tentar
+        try: backend.importar_de_sheets(BackendSheets())
+        except Exception as e: obter_telemetria().erro("armazenamento.importar", e)
+        threading.Thread(target=_ciclo_sinc_sheets, args=(backend,), daemon=True, name="sinc_sheets").start()
+    return backend
+
+# --- 5. ESCRITAS EM SEGUNDO PLANO ---
+MAX_TENTATIVAS_ESCRITA = 8  # depois disto a escrita fica marcada como falhada e aparece na barra lateral
+
+class DiarioEscritas:
+    """Diário local (SQLite) das escritas de faturas ainda por enviar ao backend. A escrita fica
+    gravada aqui antes de se responder ao utilizador; um fio envia-as por ordem, em lotes, espera
+    cada vez mais quando o Google falha e, depois de reiniciar, retoma o que ficou por enviar."""
+
+    def __init__(self, caminho):
+        self.lock = threading.RLock()
+        self.envio = threading.Lock()  # o fio de envio e a recarga da cache não podem correr ao mesmo tempo
+        self.pendente = threading.Event()
+        self.con = sqlite3.connect(caminho, check_same_thread=False)
+        with self.con:
+            self.con.execute("""CREATE TABLE IF NOT EXISTS escritas (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                operacao TEXT NOT NULL, argumentos TEXT NOT NULL, tentativas INTEGER NOT NULL DEFAULT 0,
+                falhada INTEGER NOT NULL DEFAULT 0, erro TEXT NOT NULL DEFAULT '')""")
+
+    def registar(self, operacao, *argumentos):
+        with self.lock, self.con:
+            self.con.execute("INSERT INTO escritas (operacao, argumentos) VALUES (?, ?)", (operacao, json.dumps(argumentos)))
+        self.pendente.set()
+
+    def lote(self, limite=200):
+        with self.lock:
+            return self.con.execute("SELECT id, operacao, argumentos FROM escritas WHERE falhada = 0 ORDER BY id LIMIT ?", (limite,)).fetchall()
+
+    def ja_tentadas(self, ids):
+        """Alguma destas escritas já foi enviada e falhou? O Google pode tê-la aplicado na mesma (ex.: timeout)."""
+        with self.lock:
+            return self.con.execute(f"SELECT 1 FROM escritas WHERE tentativas > 0 AND id IN ({', '.join('?' * len(ids))}) LIMIT 1", list(ids)).fetchone() is not None
+
+    def tem_pendentes(self):
+        with self.lock: return self.con.execute("SELECT 1 FROM escritas WHERE falhada = 0 LIMIT 1").fetchone() is not None
+
+    def contagens(self):
+        """(pendentes, falhadas)"""
+        with self.lock:
+            return self.con.execute("SELECT COALESCE(SUM(falhada = 0), 0), COALESCE(SUM(falhada = 1), 0) FROM escritas").fetchone()
+
+    def ultimo_erro(self):
+        with self.lock:
+            row = self.con.execute("SELECT erro FROM escritas WHERE erro != '' ORDER BY id DESC LIMIT 1").fetchone()
+        return row[0] if row else ""
+
+    def concluir(self, ids):
+        with self.lock, self.con: self.con.executemany("DELETE FROM escritas WHERE id = ?", [(i,) for i in ids])
+
+    def registar_falha(self, ids, erro, definitiva=False):
+        """definitiva=True (conflito) marca logo como falhada: repetir daria o mesmo resultado."""
+        with self.lock, self.con:
+            self.con.executemany("UPDATE escritas SET tentativas = tentativas + 1, erro = ?, falhada = (? OR tentativas + 1 >= ?) WHERE id = ?",
+                                 [(erro, definitiva, MAX_TENTATIVAS_ESCRITA, i) for i in ids])
+
+    def repetir_falhadas(self):
+        # tentativas = 1 e não 0: continuam marcadas como já enviadas uma vez (ver _por_repetir)
+        with self.lock, self.con: self.con.execute("UPDATE escritas SET falhada = 0, tentativas = 1 WHERE falhada = 1")
+        self.pendente.set()
+
+    def descartar_falhadas(self):
+        with self.lock, self.con: self.con.execute("DELETE FROM escritas WHERE falhada = 1")
+
+    def reaplicar(self, cache):
+        """Depois de recarregar do backend, volta a pôr na cache as escritas que ainda lá não chegaram."""
+        for _, operacao, argumentos in _agrupar_operacoes(self.lote(limite=-1)):
+            if operacao == "inserir_faturas": cache.acrescentar(argumentos[0])
+            elif operacao == "editar_faturas":
+                alteracoes = [(cache.posicao(id_fatura), dados) for id_fatura, _, _, dados in argumentos[0]]
+                cache.editar_linhas([(p, dados) for p, dados in alteracoes if p is not None])
+            elif operacao == "eliminar_fatura":
+                p = cache.posicao(argumentos[0])
+                if p is not None: cache.eliminar_linha(p)
+
+def _por_repetir(backend, operacao, argumentos):
+    """Argumentos de uma escrita que já falhou uma vez, sem o que a tentativa anterior deixou na folha:
+    inserções cujo ID_Fatura já lá está não se voltam a acrescentar, um apagamento cuja linha já não
+    existe está feito e uma edição também, se a linha já tem a Versao seguinte e estes dados
+    (None = nada a enviar)."""
+    if operacao == "editar_faturas":
+        atuais = backend.linhas_por_id({a[0] for a in argumentos[0]})
+        i_versao = COLUNAS_FATURAS.index("Versao")
+        def _feita(id_fatura, versao, _, dados):
+            linha = atuais.get(id_fatura)
+            return (linha is not None and _num_versao(linha[i_versao]) == _num_versao(versao) + 1
+                    and [str(x).strip() for x in linha[:len(dados)]] == [str(x).strip() for x in dados])
+        alteracoes = [a for a in argumentos[0] if not _feita(*a)]
+        return [alteracoes] if alteracoes else None
+    if operacao not in ("inserir_faturas", "eliminar_fatura"): return argumentos
+    na_folha = backend.ids_na_folha()
+    if operacao == "eliminar_fatura": return argumentos if argumentos[0] in na_folha else None
+    i_id = COLUNAS_FATURAS.index("ID_Fatura")
+    linhas = [l for l in argumentos[0] if l[i_id] not in na_folha]
+    return [linhas] if linhas else None
+
+def _ciclo_escritas(diario, backend, cache):
+    falhas = 0
+    while True:
+        ids = []
         try:
-            sheet = wb.worksheet("Validades")
-            data = sheet.get_all_records()
-            df_base = pd.DataFrame({"Matricula": LISTA_VIATURAS})
-            if not data: 
-                for c in ["Data_Seguro", "Data_Inspecao", "Data_IUC", "Observacoes"]: df_base[c] = ""
-                return df_base
-            return pd.merge(df_base, pd.DataFrame(data), on="Matricula", how="left").fillna("")
-        except: return pd.DataFrame()
-    return pd.DataFrame()
+            for ids, operacao, argumentos in _agrupar_operacoes(diario.lote()):
+                with diario.envio:
+                    if diario.ja_tentadas(ids): argumentos = _por_repetir(backend, operacao, argumentos)
+                    if argumentos is not None: getattr(backend, operacao)(*argumentos)
+                    diario.concluir(ids)
+            falhas = 0
+        except ConflitoFatura as e:
+            # Repetir não adianta: fica como falhada e a cache deixa de mostrar a nossa versão
+            diario.registar_falha(ids, f"Conflito: {e}", definitiva=True)
+            cache.invalidar()
+            continue
+        except Exception as e:
+            falhas += 1
+            diario.registar_falha(ids, f"{type(e).__name__}: {e}"[:500])
+        if falhas: time.sleep(_espera_backoff(falhas)); continue
+        diario.pendente.wait(INTERVALO_SINC_SHEETS)
+        diario.pendente.clear()
 
-def guardar_validade_nova(dados):
-    wb = conectar_gsheets()
-    if wb:
+@st.cache_resource(show_spinner=False)
+def obter_diario():
+    """Diário de escritas assíncronas, só com o backend Sheets (o SQLite já grava localmente e
+    sincroniza sozinho). Desliga-se com escrita_assincrona = false em [armazenamento]."""
+    backend = obter_backend()
+    if backend.nome != "sheets" or not ler_config("armazenamento", "escrita_assincrona", True): return None
+    diario = DiarioEscritas(ler_config("armazenamento", "caminho_diario", "diario_escritas.db"))
+    threading.Thread(target=_ciclo_escritas, args=(diario, backend, obter_cache_faturas()), daemon=True, name="escritas").start()
+    return diario
+
+def _escrever(operacao, *argumentos):
+    """Entrega a escrita ao diário (resposta imediata) ou, sem diário, diretamente ao backend."""
+    diario = obter_diario()
+    if diario: diario.registar(operacao, *argumentos)
+    else: getattr(obter_backend(), operacao)(*argumentos)
+
+def estado_escritas():
+    """(pendentes, falhadas) das escritas que ainda não chegaram ao Google Sheets."""
+    try:
+        diario = obter_diario()
+        if diario: return tuple(diario.contagens())
+        backend = obter_backend()
+        return (backend.pendentes_sinc(), backend.conflitos_sinc()[0]) if backend.nome == "sqlite" else (0, 0)
+    except Exception as e: obter_telemetria().erro("escritas.estado", e); return (0, 0)
+
+# --- 6. FUNÇÕES DE DADOS (FATURAS) ---
+TTL_CACHE_FATURAS = 300  # segundos até voltar a confirmar no backend o que outros utilizadores gravaram
+
+class IndiceFaturas:
+    """Num_Fatura -> posições (0 = primeira fatura) das linhas com esse número, mantido a cada escrita."""
+
+    def __init__(self, numeros=()):
+        self.posicoes = {}
+        self.duplicados = set()
+        for pos, nf in enumerate(numeros): self.inserir(nf, pos)
+
+    def inserir(self, nf, pos):
+        nf = str(nf).strip()
+        if not nf: return
+        lista = self.posicoes.setdefault(nf, [])
+        lista.append(pos)
+        if len(lista) > 1: self.duplicados.add(nf)
+
+    def retirar(self, nf, pos):
+        nf = str(nf).strip()
+        lista = self.posicoes.get(nf)
+        if not lista or pos not in lista: return
+        lista.remove(pos)
+        if not lista: del self.posicoes[nf]
+        if len(lista) < 2: self.duplicados.discard(nf)
+
+    def eliminar(self, nf, pos):
+        """Tira a linha e puxa uma posição para cima tudo o que estava depois dela."""
+        self.retirar(nf, pos)
+        for lista in self.posicoes.values():
+            for i, p in enumerate(lista):
+                if p > pos: lista[i] = p - 1
+
+    def existe(self, nf):
+        return str(nf).strip() in self.posicoes
+
+    def linhas(self, nf):
+        return list(self.posicoes.get(str(nf).strip(), []))
+
+class CacheFaturas:
+    """Cópia das faturas partilhada pelo processo, com o índice de Num_Fatura. As nossas escritas
+    atualizam-nas diretamente e sobem a versão; quando o TTL acaba o backend só traz o que mudou."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.leitura = threading.Lock()  # um refrescamento de cada vez vai ao backend (fora do lock, ver _trocar_cache)
+        self.df = None
+        self.indice = IndiceFaturas()
+        self.versao = 0
+        self.tipadas = None  # tipar_faturas(df) da versao_tipadas (índice = posição da linha em df)
+        self.versao_tipadas = -1
+        self.rollup = None  # RollupMensal das tipadas, mantido em conjunto com elas
+        self.derivados = {}  # nome -> (versao_tipadas, resultado), ver calcular_por_versao
+        self.carregado_em = 0.0
+        self.sinc_total_em = 0.0
+        self.mapa_ids = (None, {})  # (versao, ID_Fatura -> posição), ver posicao
+
+    def fresco(self):
+        return self.df is not None and time.time() - self.carregado_em < TTL_CACHE_FATURAS
+
+    def precisa_total(self):
+        return self.df is None or time.time() - self.sinc_total_em >= INTERVALO_SINC_TOTAL
+
+    def guardar(self, df, total=True):
+        with self.lock:
+            self.df = df
+            self.indice = IndiceFaturas(df["Num_Fatura"] if "Num_Fatura" in df.columns else ())
+            self.carregado_em = time.time()
+            if total: self.sinc_total_em = self.carregado_em
+            self.versao += 1
+
+    def posicao(self, id_fatura):
+        """Posição atual da fatura com esse ID (None se já não existe); o mapa refaz-se uma vez por versão."""
+        with self.lock:
+            id_fatura = str(id_fatura).strip()
+            if self.df is None or not id_fatura: return None
+            if self.mapa_ids[0] != self.versao:
+                self.mapa_ids = (self.versao, {v: p for p, v in enumerate(self.df["ID_Fatura"].astype(str).str.strip()) if v})
+            return self.mapa_ids[1].get(id_fatura)
+
+    def versao_de(self, id_fatura):
+        """Versao da fatura na cache, ou None se já não existe."""
+        with self.lock:
+            p = self.posicao(id_fatura)
+            return None if p is None else _num_versao(self.df.at[p, "Versao"])
+
+    def confirmar(self):
+        """Refrescamento sem alterações: os dados continuam válidos, a versão não muda."""
+        with self.lock: self.carregado_em = time.time()
+
+    def invalidar(self):
+        with self.lock:
+            self.df = None
+            self.indice = IndiceFaturas()
+            self.tipadas = self.rollup = None
+            self.versao += 1
+
+    def _mudar(self, funcao, funcao_tipadas):
+        # Se a cópia local não aguentar a alteração, deita-se fora e a próxima leitura vai ao backend.
+        # As tipadas e o rollup, se estavam em dia, acompanham a alteração só nas linhas mexidas.
+        with self.lock:
+            if self.df is None: return
+            tipadas_em_dia = self.tipadas is not None and self.rollup is not None and self.versao_tipadas == self.versao
+            try: funcao()
+            except Exception as e: obter_telemetria().erro("dados.cache", e); self.invalidar(); return
+            self.versao += 1
+            if not tipadas_em_dia: return
+            try:
+                funcao_tipadas()
+                self.versao_tipadas = self.versao
+            except Exception as e: obter_telemetria().erro("dados.cache_tipadas", e); self.tipadas = self.rollup = None
+
+    def acrescentar(self, linhas):
+        """Junta linhas ao fim (as nossas inserções ou as novas trazidas do backend)."""
+        n = len(self.df) if self.df is not None else 0
+        def _aplicar():
+            colunas = self.df.columns
+            novas = pd.DataFrame([_linha_texto(l, len(colunas))[:len(colunas)] for l in linhas], columns=colunas)
+            self.df = pd.concat([self.df, novas], ignore_index=True)
+            if "Num_Fatura" in colunas:
+                for i, nf in enumerate(novas["Num_Fatura"]): self.indice.inserir(nf, n + i)
+        def _aplicar_tipadas():
+            novas = tipar_faturas(self.df.iloc[n:])
+            self.tipadas = pd.concat([self.tipadas, novas])
+            self.rollup.somar(novas)
+        self._mudar(_aplicar, _aplicar_tipadas)
+
+    def editar_linhas(self, alteracoes):
+        posicoes = [indice for indice, _ in alteracoes]
+        def _aplicar():
+            df = self.df.copy()
+            for indice, dados in alteracoes:
+                nf_antigo = df.at[indice, "Num_Fatura"]
+                df.iloc[indice, :len(dados)] = _linha_texto(dados)
+                df.at[indice, "Versao"] = str(_num_versao(df.at[indice, "Versao"]) + 1)
+                self.indice.retirar(nf_antigo, indice)
+                self.indice.inserir(df.at[indice, "Num_Fatura"], indice)
+            self.df = df
+        def _aplicar_tipadas():
+            antigas = self.tipadas.loc[self.tipadas.index.intersection(posicoes)]
+            novas = tipar_faturas(self.df.loc[posicoes])
+            self.tipadas = pd.concat([self.tipadas.drop(index=antigas.index), novas]).sort_index()
+            self.rollup.recalcular(self.tipadas, pd.concat([antigas, novas]))
+        self._mudar(_aplicar, _aplicar_tipadas)
+
+    def eliminar_linha(self, indice):
+        def _aplicar():
+            nf = self.df.at[indice, "Num_Fatura"]
+            self.df = self.df.drop(index=indice).reset_index(drop=True)
+            self.indice.eliminar(nf, indice)
+        def _aplicar_tipadas():
+            antiga = self.tipadas.loc[self.tipadas.index.intersection([indice])]
+            tipadas = self.tipadas.drop(index=antiga.index)
+            tipadas.index = tipadas.index.where(tipadas.index < indice, tipadas.index - 1)
+            self.tipadas = tipadas
+            self.rollup.recalcular(self.tipadas, antiga)
+        self._mudar(_aplicar, _aplicar_tipadas)
+
+@st.cache_resource(show_spinner=False)
+def obter_cache_faturas():
+    return CacheFaturas()
+
+def _precisa_leitura_total(cache):
+    """A próxima leitura das faturas vai ter de trazer a folha toda (cache vazia ou sincronização total)?"""
+    diario = obter_diario()
+    if diario and diario.tem_pendentes(): return cache.df is None
+    return not cache.fresco() and cache.precisa_total()
+
+TENTATIVAS_TROCA = 3  # leituras do backend deitadas fora (a cache mudou entretanto) antes de desistir
+
+def _precisa_leitura(cache, forcar=False):
+    """Com escritas por enviar a cache está à frente do backend e só se lê se estiver vazia."""
+    diario = obter_diario()
+    if diario and diario.tem_pendentes(): return cache.df is None
+    return forcar or not cache.fresco()
+
+def _trocar_cache(cache, data=None, reaplicar=False):
+    """Lê o backend sem trancar a cache (as outras sessões continuam a usá-la) e troca o resultado sob
+    o lock. Devolve False, sem lhe mexer, se entretanto a cache mudou ou há escritas por enviar que a
+    leitura não tem; com reaplicar=True estas voltam a pôr-se por cima (DiarioEscritas.reaplicar)."""
+    diario = obter_diario()
+    with cache.lock: df, versao, total = cache.df, cache.versao, cache.precisa_total()
+    aplicar = obter_backend().ler_mudancas(df, total, data)
+    with cache.lock:
+        if cache.versao != versao or (diario and diario.tem_pendentes() and not reaplicar): return False
+        aplicar(cache)
+        if reaplicar: diario.reaplicar(cache)
+        return True
+
+@medido("dados.refrescar")
+def _refrescar_cache(cache, forcar=False):
+    """Garante a cache em dia; forcar=True ignora o TTL (antes de escrever, para validar duplicados).
+    Chamar sem cache.lock: a ida ao backend faz-se fora dele (_trocar_cache) e, se outra sessão já
+    está a ler, quem tem dados usa-os como estão em vez de esperar."""
+    diario = obter_diario()
+    for _ in range(TENTATIVAS_TROCA):
+        if not _precisa_leitura(cache, forcar) or not cache.leitura.acquire(blocking=forcar or cache.df is None): break
         try:
-            sheet = wb.worksheet("Validades")
-            try: cell = sheet.find(dados[0])
-            except: cell = None
-            if cell:
-                linha = cell.row
-                sheet.update(f"B{linha}:E{linha}", [[dados[1], dados[2], dados[3], dados[4]]])
-            else: sheet.append_row(dados)
-            return True
-        except: return False
-    return False
-
-# --- 5. LOGO ---
+            # Com diário, o envio fica parado durante a leitura (senão uma escrita enviada a meio perdia-se)
+            with (diario.envio if diario else nullcontext()):
+                if not _precisa_leitura(cache, forcar) or _trocar_cache(cache, reaplicar=bool(diario and diario.tem_pendentes())): break
+        finally: cache.leitura.release()
+    if cache.df is None: raise RuntimeError("Faturas indisponíveis")
+
+MESES_PT = {1: "Jan", 2: "Fev", 3: "Mar", 4: "Abr", 5: "Mai", 6: "Jun", 7: "Jul", 8: "Ago", 9: "Set", 10: "Out", 11: "Nov", 12: "Dez"}
+
+def numero_pt(serie):
+    """Texto em formato português ("1.234,50 €", "80,00", "53.33") -> float, de uma vez para a coluna toda."""
+    v = serie.astype(str).str.replace("€", "", regex=False).str.replace(r"\s", "", regex=True)
+    com_milhares = v.str.contains(".", regex=False) & v.str.contains(",", regex=False)
+    v = v.where(~com_milhares, v.str.replace(".", "", regex=False))
+    return pd.to_numeric(v.str.replace(",", ".", regex=False), errors="coerce").fillna(0.0)
+
+def formatar_euros(serie):
+    return serie.map("{:,.2f} €".format).astype(str).str.replace(",", "X", regex=False).str.replace(".", ",", regex=False).str.replace("X", ".", regex=False)
+
+def _campo_descricao(descricao, etiqueta):
+    """Valor numérico de "<etiqueta>: 1.500€" dentro da Descricao (0 se não existir)."""
+    return numero_pt(descricao.str.extract(etiqueta + r"\s*([\d.,]+)", expand=False).fillna(""))
+
+@medido("dados.tipar")
+def tipar_faturas(df):
+    """Esquema tipado das faturas: Valor/Litros/Preco_Litro/AdBlue em float, KM_Atuais em int,
+    Data_Fatura em datetime (linhas sem data válida ficam de fora) e as colunas de Ano/Mês.
+    Faturas antigas sem Litros/Preco_Litro/AdBlue próprios vão buscá-los à Descricao."""
+    df = df.copy()
+    for c in COLUNAS_FATURAS:
+        if c not in df.columns: df[c] = ""
+    df['Data_Fatura'] = pd.to_datetime(df['Data_Fatura'], errors='coerce')
+    df = df.dropna(subset=['Data_Fatura'])
+    descricao = df['Descricao'].astype(str)
+    df['Valor'] = numero_pt(df['Valor'])
+    df['KM_Atuais'] = pd.to_numeric(df['KM_Atuais'], errors='coerce').fillna(0).astype(int)
+    for coluna, etiqueta in [('Litros', 'Litros:'), ('Preco_Litro', 'Preço/L:'), ('AdBlue', 'AdBlue:')]:
+        proprio = df[coluna].astype(str).str.strip() != ""
+        df[coluna] = numero_pt(df[coluna]).where(proprio, _campo_descricao(descricao, etiqueta))
+    df['Valor_Visual'] = formatar_euros(df['Valor'])
+    df['Ano'] = df['Data_Fatura'].dt.year.astype(int)
+    df['Mês'] = df['Data_Fatura'].dt.month.astype(int)
+    df['Nome_Mês'] = df['Mês'].map(MESES_PT)
+    return df
+
+def _colunas_combustivel(dados):
+    """Litros, Preco_Litro e AdBlue (texto) de uma linha A:G, tirados da Descricao como em tipar_faturas;
+    um de Litros/Preço/L que falte calcula-se do outro com o Valor. Fora do Combustível ficam vazias."""
+    if str(dados[COLUNAS_FATURAS.index("Categoria")]) != "Combustível": return ["", "", ""]
+    descricao = pd.Series([str(dados[COLUNAS_FATURAS.index("Descricao")])])
+    litros, preco, adblue = (float(_campo_descricao(descricao, e).iloc[0]) for e in ("Litros:", "Preço/L:", "AdBlue:"))
+    valor = float(numero_pt(pd.Series([str(dados[COLUNAS_FATURAS.index("Valor")])])).iloc[0])
+    if litros <= 0 and preco > 0: litros = valor / preco
+    if preco <= 0 and litros > 0: preco = valor / litros
+    return [f"{litros:.2f}".replace('.', ','), f"{preco:.3f}".replace('.', ','), f"{adblue:.2f}".replace('.', ',')]
+
+def carregar_faturas_tipadas():
+    """Faturas já tipadas, calculadas uma só vez por versão dos dados. O DataFrame é partilhado
+    entre reruns: não o alterar (usar .copy() antes de acrescentar colunas)."""
+    cache = obter_cache_faturas()
+    try: _refrescar_cache(cache)
+    except Exception as e: obter_telemetria().erro("dados.refrescar", e); return pd.DataFrame()
+    with cache.lock: return _tipadas_em_dia(cache)
+
+def _tipadas_em_dia(cache):
+    """As tipadas (e o rollup) da versão atual da cache, sem ir ao backend: chamar com cache.lock."""
+    if cache.df is None: return pd.DataFrame()
+    if cache.tipadas is None or cache.rollup is None or cache.versao_tipadas != cache.versao:
+        cache.tipadas, cache.versao_tipadas = tipar_faturas(cache.df), cache.versao
+        cache.rollup = RollupMensal(cache.tipadas)
+    return cache.tipadas
+
+class RollupMensal:
+    """Totais por (Ano, Mês, Matricula, Categoria): Valor, N (nº de faturas), Litros e KM_Max (maior
+    leitura do odómetro). Inserções somam-se; edições e apagamentos recalculam só as chaves tocadas."""
+    CHAVE = ["Ano", "Mês", "Matricula", "Categoria"]
+
+    def __init__(self, tipadas):
+        self.tabela = self.agregar(tipadas)
+
+    @classmethod
+    def agregar(cls, tipadas):
+        return tipadas.groupby(cls.CHAVE).agg(Valor=('Valor', 'sum'), N=('Valor', 'size'), Litros=('Litros', 'sum'), KM_Max=('KM_Atuais', 'max'))
+
+    @classmethod
+    def combinar(cls, tabelas):
+        """Soma tabelas já agregadas (ex.: a da folha principal e as dos anos arquivados)."""
+        return pd.concat(tabelas).groupby(level=cls.CHAVE).agg({'Valor': 'sum', 'N': 'sum', 'Litros': 'sum', 'KM_Max': 'max'})
+
+    def _juntar(self, parcial):
+        self.tabela = self.combinar([self.tabela, parcial])
+
+    def somar(self, novas):
+        if len(novas): self._juntar(self.agregar(novas))
+
+    def recalcular(self, tipadas, linhas_tocadas):
+        """Refaz as chaves das linhas_tocadas a partir das tipadas (já com a alteração feita)."""
+        if not len(linhas_tocadas): return
+        chaves = pd.MultiIndex.from_frame(linhas_tocadas[self.CHAVE]).unique()
+        self.tabela = self.tabela[~self.tabela.index.isin(chaves)]
+        afetadas = tipadas[pd.MultiIndex.from_frame(tipadas[self.CHAVE]).isin(chaves)]
+        self.somar(afetadas)
+
+def obter_rollup():
+    """Tabela do RollupMensal (índice Ano, Mês, Matricula, Categoria) em dia com as faturas."""
+    cache = obter_cache_faturas()
+    carregar_faturas_tipadas()
+    with cache.lock:
+        _tipadas_em_dia(cache)
+        return cache.rollup.tabela if cache.rollup is not None else pd.DataFrame(columns=['Valor', 'N', 'Litros', 'KM_Max'])
+
+@medido("dados.rollup_filtrado")
+def rollup_filtrado(ano=None, mes=None, matriculas=None, categorias=None, anos_arquivo=()):
+    """Linhas do rollup (uma por ano/mês/viatura/categoria) que respeitam os filtros do Resumo,
+    somando os totais dos anos_arquivo pedidos."""
+    r = obter_rollup()
+    if anos_arquivo: r = RollupMensal.combinar([r, rollup_arquivo(anos_arquivo)])
+    r = r.reset_index()
+    if r.empty: return r
+    filtro = pd.Series(True, index=r.index)
+    if ano: filtro &= r['Ano'] == ano
+    if mes: filtro &= r['Mês'] == mes
+    if matriculas: filtro &= r['Matricula'].isin(matriculas)
+    if categorias: filtro &= r['Categoria'].isin(categorias)
+    return r[filtro]
+
+def calcular_por_versao(nome, funcao):
+    """funcao(faturas_tipadas) calculada uma vez e reaproveitada até os dados mudarem."""
+    cache = obter_cache_faturas()
+    carregar_faturas_tipadas()
+    with cache.lock:
+        df = _tipadas_em_dia(cache)
+        versao, valor = cache.derivados.get(nome, (None, None))
+        if versao != cache.versao_tipadas:
+            valor = funcao(df)
+            cache.derivados[nome] = (cache.versao_tipadas, valor)
+        return valor
+
+def memorizar_por_versao(nome, chave, funcao, limite=16):
+    """funcao() memorizada por (versão dos dados, chave), guardando as `limite` chaves usadas mais
+    recentemente. Uma versão nova dos dados começa com a memória vazia."""
+    cache = obter_cache_faturas()
+    memoria = calcular_por_versao(nome, lambda df: OrderedDict())
+    with cache.lock:
+        if chave in memoria:
+            memoria.move_to_end(chave)
+            return memoria[chave]
+    valor = funcao()
+    with cache.lock:
+        memoria[chave] = valor
+        while len(memoria) > limite: memoria.popitem(last=False)
+    return valor
+
+def fatura_existe(nf):
+    """Diz se o Nº de fatura já está gravado (na folha principal ou num ano arquivado), pelos índices."""
+    arquivados = numeros_arquivados()
+    cache = obter_cache_faturas()
+    try: _refrescar_cache(cache)
+    except Exception as e: obter_telemetria().erro("dados.refrescar", e); return False
+    with cache.lock:
+        return cache.indice.existe(nf) or str(nf).strip() in arquivados
+
+def faturas_existentes(numeros):
+    """Dos Nºs dados, os que já estão gravados (uma só passagem pelos índices)."""
+    arquivados = numeros_arquivados()
+    cache = obter_cache_faturas()
+    try: _refrescar_cache(cache)
+    except Exception as e: obter_telemetria().erro("dados.refrescar", e); return set()
+    with cache.lock:
+        return {nf for nf in numeros if cache.indice.existe(nf) or str(nf).strip() in arquivados}
+
+def faturas_duplicadas():
+    """Nºs repetidos na folha principal, nos anos arquivados ou entre uns e outros. Uma linha arquivada
+    cujo ID_Fatura ainda está na folha principal (arquivo a meio) é a mesma fatura e só conta lá."""
+    arquivados = numeros_arquivados()
+    cache = obter_cache_faturas()
+    try: _refrescar_cache(cache)
+    except Exception as e: obter_telemetria().erro("dados.refrescar", e); return []
+    with cache.lock:
+        so_arquivo = {nf: [i for i in ids if cache.posicao(i) is None] for nf, ids in arquivados.items()}
+        return sorted(cache.indice.duplicados | {nf for nf, ids in so_arquivo.items() if len(ids) > 1 or (ids and cache.indice.existe(nf))})
+
+LINHAS_POR_PAGINA = 50  # faturas mostradas de cada vez no editor e no detalhe
+
+def chaves_pesquisa(df):
+    """Nº de fatura e matrícula em minúsculas, uma coluna de texto cada, para pesquisar sem converter tudo a cada execução."""
+    return pd.DataFrame({c: df[c].astype(str).str.strip().str.lower() for c in ["Num_Fatura", "Matricula"]}, index=df.index)
+
+def pesquisar_faturas(texto, campos=("Num_Fatura", "Matricula")):
+    """Índices das tipadas cujo Nº de fatura ou matrícula contém o texto (maiúsculas/minúsculas tanto faz)."""
+    chaves = calcular_por_versao("pesquisa", chaves_pesquisa)
+    texto = str(texto).strip().lower()
+    if not texto: return chaves.index
+    encontrados = pd.Series(False, index=chaves.index)
+    for c in campos: encontrados |= chaves[c].str.contains(texto, regex=False)
+    return chaves.index[encontrados.to_numpy()]
+
+class MotorFiltros:
+    """Filtros do Resumo sobre as tipadas de uma versão dos dados. Ano, Mês, Matricula e Categoria
+    ficam como categorias com as posições das linhas de cada valor já calculadas: combinar filtros
+    é intersetar essas posições (sem máscaras nem df.copy()) e cada combinação fica memorizada."""
+    COLUNAS = ["Ano", "Mês", "Matricula", "Categoria"]
+    LIMITE_MEMORIA = 64  # combinações de filtros guardadas; sai a usada há mais tempo
+
+    def __init__(self, tipadas):
+        self.df = tipadas
+        self.posicoes = {}  # coluna -> {valor: posições (ordenadas) das linhas com esse valor}
+        for c in self.COLUNAS:
+            categorias = pd.Categorical(tipadas[c].to_numpy())
+            grupos = pd.Series(np.arange(len(tipadas))).groupby(categorias.codes).indices
+            self.posicoes[c] = {categorias.categories[k]: pos for k, pos in grupos.items() if k >= 0}
+        self.chaves = None  # Num_Fatura em minúsculas, só calculado à primeira pesquisa
+        self.memoria = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _de_valores(self, coluna, valores):
+        partes = [self.posicoes[coluna].get(v, np.empty(0, dtype=np.intp)) for v in valores]
+        return partes[0] if len(partes) == 1 else np.sort(np.concatenate(partes))
+
+    def posicoes_de(self, ano=None, mes=None, matriculas=(), categorias=(), doc=""):
+        """Posições das linhas que passam todos os filtros (None = sem filtros, todas)."""
+        doc = str(doc or "").strip().lower()
+        chave = (ano, mes, tuple(sorted(matriculas or ())), tuple(sorted(categorias or ())), doc)
+        with self.lock:
+            if chave in self.memoria:
+                self.memoria.move_to_end(chave)
+                return self.memoria[chave]
+        conjuntos = []
+        if ano is not None: conjuntos.append(self._de_valores("Ano", [ano]))
+        if mes is not None: conjuntos.append(self._de_valores("Mês", [mes]))
+        if matriculas: conjuntos.append(self._de_valores("Matricula", chave[2]))
+        if categorias: conjuntos.append(self._de_valores("Categoria", chave[3]))
+        if doc:
+            if self.chaves is None: self.chaves = self.df["Num_Fatura"].astype(str).str.strip().str.lower()
+            conjuntos.append(np.flatnonzero(self.chaves.str.contains(doc, regex=False).to_numpy()))
+        posicoes = None
+        for conjunto in sorted(conjuntos, key=len):  # a começar pelo mais pequeno, cada interseção é mais barata
+            posicoes = conjunto if posicoes is None else np.intersect1d(posicoes, conjunto, assume_unique=True)
+        with self.lock:
+            self.memoria[chave] = posicoes
+            if len(self.memoria) > self.LIMITE_MEMORIA: self.memoria.popitem(last=False)
+        return posicoes
+
+    def filtrar(self, **filtros):
+        posicoes = self.posicoes_de(**filtros)
+        return self.df if posicoes is None else self.df.iloc[posicoes]
+
+def filtrar_faturas(ano=None, mes=None, matriculas=(), categorias=(), doc="", anos_arquivo=()):
+    """Tipadas (mais as dos anos_arquivo pedidos) que respeitam os filtros do Resumo (mes em número).
+    Sem filtros devolve o próprio DataFrame partilhado: não o alterar."""
+    if anos_arquivo:
+        motor = memorizar_por_versao("filtros_arquivo", _chave_arquivo(anos_arquivo), lambda: MotorFiltros(faturas_visiveis(anos_arquivo)), limite=2)
+    elif (matriculas or ano is not None) and obter_backend().nome == "sqlite":
+        return _filtrar_na_base(ano, mes, matriculas, categorias, doc)
+    else: motor = calcular_por_versao("filtros", MotorFiltros)
+    return motor.filtrar(ano=ano, mes=mes, matriculas=matriculas, categorias=categorias, doc=doc)
+
+def _filtrar_na_base(ano, mes, matriculas, categorias, doc):
+    """SQLite com viatura e/ou ano escolhidos: as linhas saem dos índices da base (consultar_ids) e
+    devolvem-se as tipadas dessas linhas, com os mesmos rótulos que na cópia em memória."""
+    chave = (ano, mes, tuple(sorted(matriculas or ())), tuple(sorted(categorias or ())))
+    def _consultar():
+        cache = obter_cache_faturas()
+        carregar_faturas_tipadas()
+        with cache.lock:
+            tipadas = _tipadas_em_dia(cache)
+            if tipadas.empty: return tipadas
+            ids = obter_backend().consultar_ids(chave[2], ano, mes, chave[3])
+            return tipadas[tipadas.index.isin([p for p in map(cache.posicao, ids) if p is not None])]
+    df = memorizar_por_versao("filtros_base", chave, _consultar, limite=MotorFiltros.LIMITE_MEMORIA)
+    doc = str(doc or "").strip().lower()
+    return df[df["Num_Fatura"].astype(str).str.strip().str.lower().str.contains(doc, regex=False)] if doc else df
+
+def pagina_de(indices, chave):
+    """Seletor de página; devolve só os índices dessa página, os mais recentes primeiro."""
+    n_paginas = max(1, -(-len(indices) // LINHAS_POR_PAGINA))
+    pagina = st.number_input(f"Página (de {n_paginas}):", min_value=1, max_value=n_paginas, value=1, step=1, key=f"{chave}_{n_paginas}") if n_paginas > 1 else 1
+    inicio = (int(pagina) - 1) * LINHAS_POR_PAGINA
+    return indices[::-1][inicio:inicio + LINHAS_POR_PAGINA]
+
+def numerar_repetidos(numeros, anteriores):
+    """Nºs de fatura de linhas gravadas juntas (Series de texto): a 2.ª linha com o mesmo Nº fica
+    "<Nº>#2", a 3.ª "<Nº>#3"..., para cada fatura ter um Nº só seu e não cair em faturas_duplicadas.
+    anteriores (Counter) conta as linhas já gravadas com cada Nº e fica atualizado."""
+    ordem = numeros.groupby(numeros).cumcount() + numeros.map(anteriores).astype(int)
+    anteriores.update(numeros[numeros != ""])
+    return numeros.where((ordem == 0) | (numeros == ""), numeros + "#" + (ordem + 1).astype(str))
+
+@medido("dados.guardar")
+def guardar_registos(linhas, verificar_duplicado=True, permitidos=()):
+    """Grava várias faturas num só pedido (tudo ou nada). Recusa (False) se algum Nº de fatura
+    já existir, confirmado com o backend no momento da escrita. Linhas do mesmo lote com o mesmo Nº
+    (ex.: uma lavagem de várias viaturas numa só fatura) ficam numeradas (numerar_repetidos);
+    permitidos são Nºs que podem já existir (gravados por lotes anteriores da mesma importação)."""
+    if not linhas: return True
+    i_nf = COLUNAS_FATURAS.index("Num_Fatura")
+    linhas = [list(l) for l in linhas]
+    for l, nf in zip(linhas, numerar_repetidos(pd.Series([str(l[i_nf]).strip() for l in linhas]), Counter())): l[i_nf] = nf
+    numeros = {l[i_nf] for l in linhas} - {""}
+    cache = obter_cache_faturas()
+    verificar = verificar_duplicado and numeros
+    if verificar:
+        try: _refrescar_cache(cache, forcar=True)
+        except Exception as e: obter_telemetria().erro("dados.refrescar", e); return False
+        arquivados = numeros_arquivados()
+    with cache.lock:
+        if verificar:
+            # Sem cache (descartada depois de um conflito) não há contra o que confirmar os Nºs
+            if cache.df is None: return False
+            if any(cache.indice.existe(nf) or nf in arquivados for nf in numeros - set(permitidos)): return False
+        linhas = [_linha_texto(list(l)[:N_COLUNAS_DADOS], N_COLUNAS_DADOS) + [novo_id_fatura(), "1"] for l in linhas]
+        try: _escrever("inserir_faturas", linhas)
+        except Exception as e: obter_telemetria().erro("escritas.inserir_faturas", e); return False
+        cache.acrescentar(linhas)
+    return True
+
+def guardar_registo(dados, verificar_duplicado=True):
+    return guardar_registos([dados], verificar_duplicado)
+
+def fatura_em_dia(id_fatura, versao):
+    """A fatura ainda existe e continua na Versao que foi lida?"""
+    cache = obter_cache_faturas()
+    try: _refrescar_cache(cache)
+    except Exception as e: obter_telemetria().erro("dados.refrescar", e); return False
+    with cache.lock:
+        v = cache.versao_de(id_fatura)
+        return v is not None and v == _num_versao(versao)
+
+@medido("dados.eliminar")
+def eliminar_registo(id_fatura, versao):
+    """Apaga a fatura pelo ID, só se continuar na Versao lida. Recusa (False) se outra pessoa
+    entretanto a alterou ou apagou (nesse caso a cache volta a ler o backend)."""
+    cache = obter_cache_faturas()
+    try: _refrescar_cache(cache)
+    except Exception as e: obter_telemetria().erro("dados.refrescar", e); return False
+    with cache.lock:
+        p = cache.posicao(id_fatura)
+        if p is None or cache.versao_de(id_fatura) != _num_versao(versao): return False
+        try: _escrever("eliminar_fatura", str(id_fatura), _num_versao(versao), p)
+        except ConflitoFatura: cache.invalidar(); return False
+        except Exception as e: obter_telemetria().erro("escritas.eliminar_fatura", e); return False
+        cache.eliminar_linha(p)
+    return True
+
+@medido("dados.editar")
+def editar_registos(alteracoes):
+    """Atualiza várias faturas ({id_fatura: (versao_lida, novos_dados)}) num só pedido, tudo ou nada.
+    Recusa (False) se alguma mudou desde que foi lida ou se passar a ter um Nº que já pertence
+    a uma linha fora do lote. Dados só até à Descricao levam também Litros/Preço/L/AdBlue refeitos
+    (_colunas_combustivel): os antigos já não batiam certo com o novo Valor ou a nova Descricao."""
+    i_nf = COLUNAS_FATURAS.index("Num_Fatura")
+    cache = obter_cache_faturas()
+    try: _refrescar_cache(cache)
+    except Exception as e: obter_telemetria().erro("dados.refrescar", e); return False
+    with cache.lock:
+        pedidos = []
+        for id_fatura, (versao, dados) in alteracoes.items():
+            p = cache.posicao(id_fatura)
+            if p is None or cache.versao_de(id_fatura) != _num_versao(versao): return False
+            dados = list(dados)[:N_COLUNAS_DADOS]
+            if len(dados) == COLUNAS_FATURAS.index("Descricao") + 1: dados = dados + _colunas_combustivel(dados)
+            pedidos.append((str(id_fatura), _num_versao(versao), p, _linha_texto(dados)))
+        editados = {p for _, _, p, _ in pedidos}
+        for _, _, p, dados in pedidos:
+            nf = str(dados[i_nf]).strip()
+            if nf and nf != str(cache.df.at[p, "Num_Fatura"]).strip() and any(q not in editados for q in cache.indice.linhas(nf)): return False
+        try: _escrever("editar_faturas", pedidos)
+        except ConflitoFatura: cache.invalidar(); return False
+        except Exception as e: obter_telemetria().erro("escritas.editar_faturas", e); return False
+        cache.editar_linhas([(p, dados) for _, _, p, dados in pedidos])
+    return True
+
+def editar_registo(id_fatura, versao, novos_dados):
+    """Atualiza a fatura pelo ID. Recusa (False) se mudou desde que foi lida ou se o Nº mudar para um que já existe."""
+    return editar_registos({id_fatura: (versao, novos_dados)})
+
+# --- 7. PARTIÇÕES POR ANO ---
+class CacheArquivo:
+    """Anos fechados, cada um na sua folha (PREFIXO_PARTICAO + ano) e listados no manifesto. O manifesto
+    e os Nºs de fatura (para os duplicados) leem-se logo; as faturas de um ano só quando são pedidas."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.manifesto = None  # ano -> (folha, linhas, atualizado_em)
+        self.numeros = None  # Num_Fatura -> ID_Fatura das linhas com esse Nº em todos os anos arquivados
+        self.anos = {}  # ano -> tipadas, só os anos já pedidos
+        self.carregado_em = 0.0
+        self.versao = 0
+
+    def invalidar(self):
+        with self.lock:
+            self.manifesto, self.numeros, self.anos = None, None, {}
+            self.versao += 1
+
+@st.cache_resource(show_spinner=False)
+def obter_cache_arquivo():
+    return CacheArquivo()
+
+def _manifesto_em_dia(cache):
+    if cache.manifesto is not None and time.time() - cache.carregado_em < INTERVALO_SINC_TOTAL: return
+    registos = obter_backend().ler_manifesto()
+    manifesto = {int(float(r["Ano"])): (str(r["Folha"]), str(r.get("Linhas", "")), str(r.get("Atualizado_Em", "")))
+                 for r in registos if str(r.get("Ano", "")).strip() and str(r.get("Folha", "")).strip()}
+    if manifesto != cache.manifesto:
+        cache.numeros, cache.anos = None, {}
+        cache.versao += 1
+    cache.manifesto, cache.carregado_em = manifesto, time.time()
+
+def anos_arquivados():
+    cache = obter_cache_arquivo()
+    with cache.lock:
+        try: _manifesto_em_dia(cache)
+        except Exception as e: obter_telemetria().erro("arquivo.manifesto", e)
+        return sorted(cache.manifesto or {})
+
+def numeros_arquivados():
+    """Nº de fatura -> ID_Fatura das linhas arquivadas com esse Nº (vazio sem arquivo ou se não se conseguiu ler)."""
+    cache = obter_cache_arquivo()
+    with cache.lock:
+        try:
+            _manifesto_em_dia(cache)
+            if cache.numeros is None: cache.numeros = obter_backend().ler_numeros_arquivo([f for f, _, _ in cache.manifesto.values()]) if cache.manifesto else {}
+        except Exception as e: obter_telemetria().erro("arquivo.numeros", e)
+        return cache.numeros or {}
+
+@medido("dados.particao")
+def particao_ano(ano):
+    """Tipadas de um ano arquivado, lidas da sua folha na primeira vez que são pedidas."""
+    cache = obter_cache_arquivo()
+    with cache.lock:
+        _manifesto_em_dia(cache)
+        if ano not in cache.anos:
+            data = obter_backend().ler_particao(cache.manifesto[ano][0])
+            df = _normalizar_faturas(data) if data else pd.DataFrame(columns=COLUNAS_FATURAS)
+            # Rótulos negativos (-(ano × 10⁶ + linha)): não se confundem com as posições da folha principal nem entre anos
+            df.index = -(ano * 1_000_000 + np.arange(1, len(df) + 1))
+            cache.anos[ano] = tipar_faturas(df)
+        return cache.anos[ano]
+
+def _chave_arquivo(anos_arquivo):
+    return (obter_cache_arquivo().versao, tuple(sorted(anos_arquivo)))
+
+def _ids_atuais():
+    ids = carregar_faturas_tipadas().get("ID_Fatura", pd.Series(dtype=str)).astype(str).str.strip()
+    return ids[ids != ""]
+
+def arquivo_visivel(anos_arquivo):
+    """Tipadas dos anos arquivados pedidos sem as linhas cujo ID_Fatura ainda está na folha principal
+    (arquivo a meio, ou alterada por outra instância enquanto se arquivava): vale a da folha principal."""
+    def _juntar():
+        arquivo = pd.concat([particao_ano(a) for a in sorted(anos_arquivo)])
+        return arquivo[~arquivo["ID_Fatura"].astype(str).str.strip().isin(_ids_atuais())]
+    return memorizar_por_versao("arquivo", _chave_arquivo(anos_arquivo), _juntar, limite=2)
+
+def rollup_arquivo(anos_arquivo):
+    """Tabela do RollupMensal de arquivo_visivel."""
+    return memorizar_por_versao("rollup_arquivo", _chave_arquivo(anos_arquivo), lambda: RollupMensal.agregar(arquivo_visivel(anos_arquivo)), limite=2)
+
+def faturas_visiveis(anos_arquivo=()):
+    """Tipadas da folha principal mais as dos anos arquivados pedidos (os mais antigos primeiro).
+    Sem anos arquivados é o próprio DataFrame partilhado: não o alterar."""
+    atual = carregar_faturas_tipadas()
+    if not anos_arquivo: return atual
+    return memorizar_por_versao("visiveis", _chave_arquivo(anos_arquivo), lambda: pd.concat([arquivo_visivel(anos_arquivo), atual]), limite=2)
+
+def segmentos_visiveis(anos_arquivo=()):
+    """Segmentos de consumo calculados sobre faturas_visiveis (o primeiro abastecimento de um ano
+    continua a contar os KMs desde o último do ano anterior)."""
+    if not anos_arquivo: return obter_segmentos_consumo()
+    return memorizar_por_versao("segmentos_visiveis", _chave_arquivo(anos_arquivo), lambda: segmentos_consumo(faturas_visiveis(anos_arquivo)), limite=2)
+
+def arquivar_anos_fechados():
+    """Arquiva os anos anteriores ao corrente (ver BackendSheets.arquivar_anos). Devolve os anos
+    movidos, ou None se agora não é possível (outro armazenamento ou escritas ainda por enviar)."""
+    backend = obter_backend()
+    if not hasattr(backend, "arquivar_anos"): return None
+    diario = obter_diario()
+    cache = obter_cache_faturas()
+    # O envio tranca-se antes da cache, pela mesma ordem que no refrescamento (_refrescar_cache)
+    with (diario.envio if diario else nullcontext()), cache.lock:
+        if diario and diario.tem_pendentes(): return None
+        try: return backend.arquivar_anos(datetime.now().year)
+        finally:
+            cache.invalidar()
+            obter_cache_arquivo().invalidar()
+
+def painel_arquivo():
+    """Expander da barra lateral (só administradores): anos arquivados e o botão para arquivar."""
+    with st.expander("🗄️ Arquivo por Ano"):
+        cache = obter_cache_arquivo()
+        anos = anos_arquivados()
+        if anos: st.dataframe(pd.DataFrame([(a, *cache.manifesto[a]) for a in anos], columns=COLUNAS_MANIFESTO), hide_index=True, use_container_width=True)
+        else: st.caption("Ainda não há anos arquivados: todas as faturas estão na folha principal.")
+        ano = datetime.now().year
+        if st.button(f"🗄️ Arquivar anos anteriores a {ano}", use_container_width=True):
+            try: movidos = arquivar_anos_fechados()
+            except Exception as e: st.error(f"Erro ao arquivar: {e}")
+            else:
+                if movidos is None: st.warning("Agora não é possível: só com o Google Sheets e depois de todas as escritas pendentes terem sido enviadas.")
+                elif movidos: st.success(f"✅ Arquivados: {', '.join(map(str, movidos))}")
+                else: st.info("Não há faturas de anos anteriores na folha principal.")
+
+# --- 8. FUNÇÕES DE DADOS (VALIDADES) ---
+TTL_CACHE_VALIDADES = 600  # segundos
+
+class CacheValidades:
+    """Folha "Validades" partilhada pelo processo e a tabela de alertas calculada a partir dela."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.df = None
+        self.versao = 0
+        self.carregado_em = 0.0
+        self.alertas = None  # (chave, tabela), ver obter_alertas
+
+@st.cache_resource(show_spinner=False)
+def obter_cache_validades():
+    return CacheValidades()
+
+def _validades_expiradas(cache):
+    return cache.df is None or time.time() - cache.carregado_em >= TTL_CACHE_VALIDADES
+
+def _guardar_validades(cache, data):
+    df_base = pd.DataFrame({"Matricula": LISTA_VIATURAS})
+    if not data: 
+        for c in COLUNAS_VALIDADES[1:]: df_base[c] = ""
+    else: df_base = pd.merge(df_base, pd.DataFrame(data), on="Matricula", how="left").fillna("")
+    cache.df, cache.carregado_em = df_base, time.time()
+    cache.versao += 1
+
+@medido("dados.validades")
+def carregar_validades():
+    cache = obter_cache_validades()
+    with cache.lock: versao, expiradas = cache.versao, _validades_expiradas(cache)
+    if expiradas:
+        # Lidas fora do lock, como as faturas (_trocar_cache): se entretanto a cache mudou, fica a dela
+        try: data = obter_backend().ler_validades()
+        except Exception as e: obter_telemetria().erro("dados.validades", e); return pd.DataFrame()
+        with cache.lock:
+            if cache.versao == versao: _guardar_validades(cache, data)
+    with cache.lock: return cache.df.copy() if cache.df is not None else pd.DataFrame()
+
+@medido("dados.guardar_validades")
+def guardar_validades_novas(linhas):
+    """Atualiza as validades de várias viaturas numa só escrita (cada linha = COLUNAS_VALIDADES)."""
+    if not linhas: return True
+    try: obter_backend().guardar_validades(linhas)
+    except Exception as e: obter_telemetria().erro("escritas.guardar_validades", e); return False
+    cache = obter_cache_validades()
+    with cache.lock:
+        if cache.df is not None:
+            novas = pd.DataFrame([_linha_texto(l, len(COLUNAS_VALIDADES))[:len(COLUNAS_VALIDADES)] for l in linhas], columns=COLUNAS_VALIDADES)
+            novas = novas.drop_duplicates("Matricula", keep="last").set_index("Matricula")
+            df = cache.df.set_index("Matricula")
+            df.update(novas)
+            cache.df = df.reset_index()
+        cache.versao += 1
+    return True
+
+def guardar_validade_nova(dados):
+    return guardar_validades_novas([dados])
+
+@medido("dados.arranque")
+def carregar_arranque():
+    """Primeira leitura de cada execução: se as faturas precisam da folha toda e as Validades também
+    estão por ler (arranque, TTL acabado), vêm as duas num só pedido ao Google em vez de um por folha.
+    O resto da execução (alertas, páginas) serve-se das caches já cheias."""
+    backend = obter_backend()
+    if not hasattr(backend, "ler_arranque"): return
+    cache_f, cache_v = obter_cache_faturas(), obter_cache_validades()
+    diario = obter_diario()
+
+    def _precisa():
+        with cache_f.lock, cache_v.lock: return _precisa_leitura_total(cache_f) and _validades_expiradas(cache_v)
+
+    def _ler_e_guardar():
+        if not _precisa(): return  # outra sessão leu enquanto esta esperava
+        with cache_v.lock: versao_v = cache_v.versao
+        try: faturas, validades = backend.ler_arranque()
+        except Exception as e: obter_telemetria().erro("dados.arranque", e); return
+        _trocar_cache(cache_f, faturas, reaplicar=diario is not None)
+        with cache_v.lock:
+            if cache_v.versao == versao_v: _guardar_validades(cache_v, validades)
+
+    if not _precisa(): return
+    # A leitura faz-se fora dos locks das caches (ver _trocar_cache). Com diário, o envio fica parado
+    # entre a leitura e o reaplicar (senão uma escrita enviada a meio perdia-se).
+    with cache_f.leitura:
+        if diario:
+            with diario.envio: _ler_e_guardar()
+        else: _ler_e_guardar()
+
+# --- 9. IMPORTAÇÃO DE EXTRATOS ---
+BLOCO_IMPORTACAO = 5000  # linhas do ficheiro lidas de cada vez (o ficheiro nunca fica todo em memória)
+LOTE_IMPORTACAO = 500  # linhas por append_rows ao gravar
+CAMPOS_IMPORTACAO = COLUNAS_FATURAS[:N_COLUNAS_DADOS]
+# Pedaços (sem acentos, minúsculas) dos nomes de coluna habituais nos extratos de cartão e da Via Verde
+PISTAS_IMPORTACAO = {
+    "Data_Fatura": ["data"], "Matricula": ["matricula", "viatura"], "Categoria": ["categoria"],
+    "Valor": ["valor", "montante", "total", "importancia"], "KM_Atuais": ["km", "quilometr", "odometro"],
+    "Num_Fatura": ["fatura", "factura", "documento", "transacao", "referencia"], "Descricao": ["descricao", "local", "posto", "produto"],
+    "Litros": ["litros", "quantidade"], "Preco_Litro": ["preco", "unitario"], "AdBlue": ["adblue"],
+}
+FORMATOS_DATA_IMPORTACAO = ("%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y", "%d.%m.%Y", "%Y/%m/%d")
+
+def _sem_acentos(texto):
+    return unicodedata.normalize("NFKD", str(texto)).encode("ascii", "ignore").decode().lower().strip()
+
+def adivinhar_mapeamento(colunas):
+    """Campo da fatura -> coluna do ficheiro, pelos nomes habituais; cada coluna serve um só campo."""
+    mapeamento, usadas = {}, set()
+    for campo, pistas in PISTAS_IMPORTACAO.items():
+        for coluna in colunas:
+            if coluna not in usadas and any(p in _sem_acentos(coluna) for p in pistas):
+                mapeamento[campo] = coluna; usadas.add(coluna)
+                break
+    return mapeamento
+
+def ler_extrato(ficheiro, bloco=BLOCO_IMPORTACAO):
+    """Gera (DataFrame de texto, fração já lida) aos blocos de um CSV (separador e codificação
+    detetados) ou de um Excel (.xlsx, lido em modo read_only do openpyxl)."""
+    ficheiro.seek(0)
+    if str(getattr(ficheiro, "name", "")).lower().endswith((".xlsx", ".xlsm")):
+        try: import openpyxl
+        except ImportError: raise RuntimeError("Para importar Excel é preciso o pacote openpyxl (ou exporta o extrato em CSV).")
+        folha = openpyxl.load_workbook(ficheiro, read_only=True, data_only=True).active
+        linhas = folha.iter_rows(values_only=True)
+        cabecalho = [str(c).strip() if c is not None else f"Coluna {i + 1}" for i, c in enumerate(next(linhas, []))]
+        total, lidas, parte = max(1, (folha.max_row or 1) - 1), 0, []
+        for linha in linhas:
+            parte.append(["" if v is None else str(v) for v in linha[:len(cabecalho)]])
+            if len(parte) == bloco:
+                lidas += len(parte)
+                yield pd.DataFrame(parte, columns=cabecalho), min(1.0, lidas / total)
+                parte = []
+        if parte: yield pd.DataFrame(parte, columns=cabecalho), 1.0
+        return
+    amostra = ficheiro.read(64 * 1024)
+    ficheiro.seek(0)
+    try: amostra.decode("utf-8"); codificacao = "utf-8-sig"
+    except UnicodeDecodeError as e: codificacao = "utf-8-sig" if e.start > len(amostra) - 4 else "cp1252"
+    texto = amostra.decode(codificacao, errors="ignore")
+    try: separador = csv.Sniffer().sniff("\n".join(texto.splitlines()[:20]) or ";", delimiters=";,\t|").delimiter
+    except csv.Error: separador = ";"
+    tamanho = max(1, getattr(ficheiro, "size", 0) or len(ficheiro.getbuffer()))
+    texto = io.TextIOWrapper(ficheiro, encoding=codificacao, newline="")
+    try:
+        for parte in pd.read_csv(texto, sep=separador, dtype=str, keep_default_na=False, chunksize=bloco, skipinitialspace=True):
+            parte.columns = [str(c).strip() for c in parte.columns]
+            yield parte, min(1.0, ficheiro.tell() / tamanho)
+    finally: texto.detach()  # sem fechar o ficheiro, que ainda pode voltar a ser lido
+
+def _datas_importacao(serie):
+    texto = serie.astype(str).str.strip().str.split(r"[ T]", n=1, regex=True).str[0]
+    datas = pd.Series(pd.NaT, index=serie.index, dtype="datetime64[ns]")
+    for formato in FORMATOS_DATA_IMPORTACAO:
+        datas = datas.fillna(pd.to_datetime(texto, format=formato, errors="coerce"))
+    return datas
+
+def _matriculas_importacao(serie):
+    """"aa 66 vn", "AA.66.VN", "AA66VN" -> "AA-66-VN"."""
+    m = serie.astype(str).str.upper().str.replace(r"[^A-Z0-9]", "", regex=True)
+    return (m.str[0:2] + "-" + m.str[2:4] + "-" + m.str[4:6]).where(m.str.len() == 6, serie.astype(str).str.strip().str.upper())
+
+def _texto_pt(serie, casas):
+    return serie.map(f"{{:.{casas}f}}".format).str.replace(".", ",", regex=False)
+
+def preparar_extrato(bloco, mapeamento, categoria=None):
+    """Bloco do ficheiro -> (linhas no formato das faturas, rejeitadas com o Motivo), tudo por colunas.
+    categoria=None tira-a da coluna mapeada. No Combustível, Litros e Preço/L entram nas colunas
+    próprias (um calcula-se do outro com o Valor) e na Descricao, como no formulário."""
+    col = lambda campo: bloco[mapeamento[campo]].astype(str).str.strip() if mapeamento.get(campo) else pd.Series("", index=bloco.index)
+    datas = _datas_importacao(col("Data_Fatura"))
+    matriculas = _matriculas_importacao(col("Matricula"))
+    categorias = pd.Series(categoria, index=bloco.index) if categoria else col("Categoria")
+    valores = numero_pt(col("Valor")).round(2)
+    numeros = col("Num_Fatura")
+
+    motivo = pd.Series("", index=bloco.index)
+    for falha, texto in [(numeros == "", "Sem Nº de fatura"), (valores <= 0, "Sem valor"), (~categorias.isin(CATEGORIAS), "Categoria desconhecida"),
+                         (~matriculas.isin(LISTA_VIATURAS), "Matrícula fora da frota"), (datas.isna(), "Data inválida")]:
+        motivo = motivo.mask(falha, texto)
+    aceites = motivo == ""
+
+    litros, preco, adblue = numero_pt(col("Litros")), numero_pt(col("Preco_Litro")), numero_pt(col("AdBlue"))
+    litros = litros.mask((litros <= 0) & (preco > 0), valores / preco.where(preco > 0))
+    preco = preco.mask((preco <= 0) & (litros > 0), valores / litros.where(litros > 0))
+    combustivel = categorias == "Combustível"
+    partes = [("Preço/L: " + preco.map("{:.3f}".format) + "€").where(combustivel & (preco > 0), ""),
+              ("Litros: " + litros.map("{:.2f}".format)).where(combustivel & (litros > 0), ""),
+              ("AdBlue: " + adblue.map("{:.2f}".format) + "€").where(combustivel & (adblue > 0), ""), col("Descricao")]
+    descricao = functools.reduce(lambda a, b: (a + " | " + b).where((a != "") & (b != ""), a + b), partes)
+
+    linhas = pd.DataFrame({
+        "Data_Fatura": datas.dt.strftime("%Y-%m-%d"), "Matricula": matriculas, "Categoria": categorias,
+        "Valor": _texto_pt(valores, 2), "KM_Atuais": pd.to_numeric(col("KM_Atuais").str.replace(r"[^\d]", "", regex=True), errors="coerce").fillna(0).astype(int).astype(str),
+        "Num_Fatura": numeros, "Descricao": descricao,
+        "Litros": _texto_pt(litros, 2).where(combustivel, ""), "Preco_Litro": _texto_pt(preco, 3).where(combustivel, ""), "AdBlue": _texto_pt(adblue, 2).where(combustivel, ""),
+    }, index=bloco.index)[CAMPOS_IMPORTACAO]
+    return linhas[aceites], bloco[~aceites].assign(Motivo=motivo[~aceites])
+
+def importar_extrato(ficheiro, mapeamento, categoria=None, simular=False, ao_progredir=None):
+    """Lê o extrato aos blocos, valida-o e grava-o em lotes de LOTE_IMPORTACAO (um append_rows cada).
+    Nºs de fatura já registados ficam de fora (índice das faturas), tal como linhas repetidas no
+    próprio ficheiro; linhas diferentes com o mesmo Nº (um extrato, várias passagens) entram todas, a
+    partir da 2.ª como "<Nº>#2", "<Nº>#3"... para o Nº continuar único (e não cair em faturas_duplicadas).
+    simular=True faz tudo menos gravar. Voltar a importar o mesmo ficheiro não duplica nada."""
+    resultado = {"lidas": 0, "gravadas": 0, "duplicadas": 0, "rejeitadas": 0, "motivos": Counter(), "exemplos": [], "previsao": [], "erro": None}
+    importados, vistas = set(), set()  # Nºs gravados por esta importação; linhas já vistas no ficheiro
+    passagens = Counter()  # Nº do ficheiro -> linhas já aceites com ele (nos blocos anteriores)
+    for bloco, fracao in ler_extrato(ficheiro):
+        bloco.index = range(resultado["lidas"] + 2, resultado["lidas"] + 2 + len(bloco))  # nº da linha no ficheiro
+        resultado["lidas"] += len(bloco)
+        linhas, rejeitadas = preparar_extrato(bloco, mapeamento, categoria)
+        resultado["rejeitadas"] += len(rejeitadas)
+        resultado["motivos"].update(rejeitadas["Motivo"])
+        if len(resultado["exemplos"]) < 200: resultado["exemplos"] += rejeitadas.reset_index(names="Linha").to_dict("records")[:200 - len(resultado["exemplos"])]
+
+        chaves = list(zip(linhas["Num_Fatura"], linhas["Data_Fatura"], linhas["Matricula"], linhas["Valor"]))
+        nova = pd.Series([c not in vistas for c in chaves], index=linhas.index) & ~pd.Series(chaves, index=linhas.index).duplicated()
+        vistas.update(chaves)
+        existentes = faturas_existentes(set(linhas["Num_Fatura"].unique()) - importados)
+        nova &= ~linhas["Num_Fatura"].isin(existentes)
+        resultado["duplicadas"] += int((~nova).sum())
+        linhas = linhas[nova]
+        linhas = linhas.assign(Num_Fatura=numerar_repetidos(linhas["Num_Fatura"], passagens))
+
+        for inicio in range(0, len(linhas), LOTE_IMPORTACAO):
+            lote = linhas.iloc[inicio:inicio + LOTE_IMPORTACAO]
+            if simular:
+                if len(resultado["previsao"]) < 200: resultado["previsao"] += lote.reset_index(names="Linha").to_dict("records")[:200 - len(resultado["previsao"])]
+            elif guardar_registos(lote.values.tolist(), permitidos=importados): importados.update(lote["Num_Fatura"])
+            else:
+                resultado["erro"] = f"O lote a começar na linha {lote.index[0]} não foi gravado (Nº registado entretanto ou falha na ligação). As linhas anteriores ficaram gravadas; volta a importar o ficheiro para continuar."
+                return resultado
+            resultado["gravadas"] += len(lote)
+        if ao_progredir: ao_progredir(fracao, resultado)
+    return resultado
+
+# --- 10. CONSUMOS DE COMBUSTÍVEL ---
+JANELA_CONSUMO_MOVEL = 5  # abastecimentos na média móvel de cada viatura
+MAX_KMS_SEGMENTO = 5000  # mais do que isto entre dois abastecimentos é quase certo um erro de odómetro
+LIMIAR_CONSUMO_ALTO = 1.5  # vezes a mediana da viatura: possível furto ou fuga de combustível
+LIMIAR_CONSUMO_BAIXO = 0.5  # vezes a mediana da viatura: KMs ou litros mal introduzidos
+
+@medido("dados.consumos")
+def segmentos_consumo(df):
+    """Um segmento por abastecimento: KMs desde o abastecimento anterior da mesma viatura e os litros
+    agora metidos (depósito cheio). Calculado para toda a frota de uma vez (ordenar + shift por viatura);
+    o índice é o da fatura do abastecimento, para se poder cruzar com os filtros."""
+    comb = df[(df['Categoria'] == 'Combustível') & (df['KM_Atuais'] > 0) & (df['Litros'] > 0)]
+    comb = comb.sort_values(['Matricula', 'Data_Fatura', 'KM_Atuais'], kind='mergesort')
+    seg = comb[['Matricula', 'Data_Fatura', 'KM_Atuais', 'Litros']].copy()
+    seg['KMs'] = seg['KM_Atuais'] - seg.groupby('Matricula')['KM_Atuais'].shift()
+    seg = seg.dropna(subset=['KMs'])
+    seg['L100'] = (seg['Litros'] / seg['KMs'].where(seg['KMs'] > 0) * 100).round(2)
+    seg['Anomalia'] = ""
+    seg.loc[seg['KMs'] > MAX_KMS_SEGMENTO, 'Anomalia'] = "Salto de KMs suspeito"
+    seg.loc[seg['KMs'] <= 0, 'Anomalia'] = "KMs não avançaram (odómetro errado?)"
+    seg['Valido'] = (seg['Anomalia'] == "") & (seg['L100'] > 0)
+    mediana = seg['L100'].where(seg['Valido'] & (seg['L100'] < 100)).groupby(seg['Matricula']).transform('median')
+    alto, baixo = seg['Valido'] & (seg['L100'] > mediana * LIMIAR_CONSUMO_ALTO), seg['Valido'] & (seg['L100'] < mediana * LIMIAR_CONSUMO_BAIXO)
+    seg.loc[alto, 'Anomalia'] = "Consumo muito acima do habitual (possível furto)"
+    seg.loc[baixo, 'Anomalia'] = "Consumo muito abaixo do habitual (KMs ou litros errados?)"
+    seg['Valido'] &= ~(alto | baixo)
+    validos = seg[seg['Valido']]
+    seg['L100_Movel'] = validos.groupby('Matricula')['L100'].rolling(JANELA_CONSUMO_MOVEL, min_periods=1).mean().reset_index(level=0, drop=True).round(2)
+    return seg
+
+def resumo_consumo(seg):
+    """Média por viatura (litros / KMs dos segmentos válidos), como antes mas sem contar os anómalos."""
+    validos = seg[seg['Valido']]
+    tot = validos.groupby('Matricula').agg(KMs=('KMs', 'sum'), Litros=('Litros', 'sum')).reset_index()
+    tot['Média (L/100km)'] = (tot['Litros'] / tot['KMs'] * 100).round(2)
+    tot = tot.rename(columns={'KMs': 'KMs Percorridos', 'Litros': 'Litros Consumidos'})
+    tot['KMs Percorridos'] = tot['KMs Percorridos'].astype(int)
+    tot['Litros Consumidos'] = tot['Litros Consumidos'].round(2)
+    return tot.sort_values('Média (L/100km)', ascending=False)
+
+def consumo_mensal(seg):
+    validos = seg[seg['Valido']]
+    mensal = validos.groupby(['Matricula', validos['Data_Fatura'].dt.to_period('M').astype(str)]).agg(KMs=('KMs', 'sum'), Litros=('Litros', 'sum')).reset_index()
+    mensal.columns = ['Matricula', 'Mês', 'KMs', 'Litros']
+    mensal['L/100km'] = (mensal['Litros'] / mensal['KMs'] * 100).round(2)
+    return mensal.sort_values(['Mês', 'Matricula'])
+
+def obter_segmentos_consumo():
+    return calcular_por_versao("segmentos_consumo", segmentos_consumo)
+
+# --- 11. GRÁFICOS DO RESUMO ---
+def graficos_resumo(agg, df_f, anos_arquivo=()):
+    """Figuras do Resumo, todas a partir de dados já agregados (rollup por ano/mês/viatura/categoria e
+    consumos por viatura e mês), com valores ao cêntimo para o JSON enviado ao browser ser pequeno.
+    Junta as tabelas de consumo e as anomalias, que saem dos mesmos segmentos."""
+    df_ev = agg.groupby(['Ano', 'Mês', 'Categoria'], as_index=False)['Valor'].sum().round({'Valor': 2})
+    df_ev['Mês'] = df_ev['Ano'].astype(str) + "-" + df_ev['Mês'].map("{:02d}".format)
+    df_cat = agg.groupby('Categoria', as_index=False)['Valor'].sum().round({'Valor': 2})
+    df_viat = agg.groupby(['Matricula', 'Categoria'], as_index=False)['Valor'].sum().round({'Valor': 2})
+
+    graficos = {
+        "evolucao": px.bar(df_ev[['Mês', 'Categoria', 'Valor']], x='Mês', y='Valor', color='Categoria', title="Evolução Mensal (Por Categoria)", text_auto='.2s'),
+        "distribuicao": px.pie(df_cat, values='Valor', names='Categoria', title="Distribuição de Custos", hole=0.4),
+        "viaturas": px.bar(df_viat, y='Matricula', x='Valor', color='Categoria', orientation='h', title="Despesas por Viatura divididas por Categoria", text_auto='.2s'),
+    }
+    graficos["viaturas"].update_layout(yaxis={'categoryorder':'total ascending'}, xaxis_title="Total Gasto (€)", yaxis_title="Viatura", height=600)
+
+    seg = segmentos_visiveis(anos_arquivo)
+    seg = seg[seg.index.isin(df_f.index)]
+    graficos["consumos"] = resumo_consumo(seg)
+    graficos["anomalias"] = seg[seg['Anomalia'] != ""].sort_values('Data_Fatura', ascending=False)
+    if not graficos["consumos"].empty:
+        graficos["fig_consumos"] = px.bar(graficos["consumos"], x='Média (L/100km)', y='Matricula', orientation='h', title="Viaturas Mais Gulosas (Média de Litros por 100km)", text_auto=True, color='Média (L/100km)', color_continuous_scale='Reds')
+        graficos["fig_consumos"].update_layout(yaxis={'categoryorder':'total ascending'})
+        df_mensal = consumo_mensal(seg)
+        if df_mensal['Mês'].nunique() > 1:
+            graficos["tendencia"] = px.line(df_mensal, x='Mês', y='L/100km', color='Matricula', markers=True, title="Evolução Mensal do Consumo (L/100km)")
+    return graficos
+
+def obter_graficos_resumo(filtros, agg, df_f, anos_arquivo=()):
+    """graficos_resumo memorizados por (versão dos dados, filtros): uma execução provocada por outro
+    widget (ex.: escrever no formulário de edição) reaproveita as figuras em vez de as refazer."""
+    chave = filtros + _chave_arquivo(anos_arquivo)
+    return memorizar_por_versao("graficos_resumo", chave, lambda: graficos_resumo(agg, df_f, anos_arquivo))
+
+# --- 12. LOGO ---
 def mostrar_logo():
     caminhos = [".streamlit/logo.png", "logo.png", ".streamlit/Logo.png", "Logo.png"]
     encontrou = False
@@ -141,24 +2028,48 @@ def mostrar_logo():
         except: continue
     if not encontrou: st.header("QERQUEIJO 🧀")
 
-# --- 6. ALERTAS ---
-def verificar_alertas(df_val):
-    if df_val.empty: return
-    hoje = datetime.now().date()
-    for _, row in df_val.iterrows():
-        mat = row['Matricula']
-        verificacoes = {"Seguro": row.get('Data_Seguro'), "Inspeção": row.get('Data_Inspecao'), "IUC": row.get('Data_IUC')}
-        for tipo, data_str in verificacoes.items():
-            if data_str and str(data_str).strip() not in ["", "None", "nan"]:
-                try:
-                    data_val = datetime.strptime(str(data_str), "%Y-%m-%d").date()
-                    dias_restantes = (data_val - hoje).days
-                    if dias_restantes < 0: st.error(f"🚨 **URGENTE ({mat}):** {tipo} expirou dia {data_val.strftime('%d/%m')}!")
-                    elif dias_restantes <= 7: st.error(f"⏰ **CRÍTICO ({mat}):** {tipo} vence em {dias_restantes} dias")
-                    elif dias_restantes <= 30: st.warning(f"⚠️ **Atenção ({mat}):** {tipo} vence em {dias_restantes} dias")
-                except: continue
-
-# --- 7. APP PRINCIPAL ---
+# --- 13. ALERTAS ---
+PRAZOS_VALIDADES = {"Seguro": "Data_Seguro", "Inspeção": "Data_Inspecao", "IUC": "Data_IUC"}
+
+def calcular_alertas(df_val, hoje, dias_critico, dias_aviso):
+    """Todos os prazos (viatura x Seguro/Inspeção/IUC) numa tabela longa, com as datas convertidas
+    de uma só vez; fica só o que vence até dias_aviso, do mais urgente para o menos urgente."""
+    colunas = [c for c in PRAZOS_VALIDADES.values() if c in df_val.columns]
+    longo = df_val.melt(id_vars="Matricula", value_vars=colunas, var_name="Coluna", value_name="Data")
+    longo["Data"] = pd.to_datetime(longo["Data"].astype(str).str.strip(), format="%Y-%m-%d", errors="coerce")
+    longo = longo.dropna(subset=["Data"])
+    longo["Dias"] = (longo["Data"] - pd.Timestamp(hoje)).dt.days
+    longo = longo[longo["Dias"] <= dias_aviso].copy()
+    longo["Tipo"] = longo["Coluna"].map({v: k for k, v in PRAZOS_VALIDADES.items()})
+    longo["Nivel"] = "aviso"
+    longo.loc[longo["Dias"] <= dias_critico, "Nivel"] = "critico"
+    longo.loc[longo["Dias"] < 0, "Nivel"] = "expirado"
+    return longo.sort_values(["Dias", "Matricula"])[["Matricula", "Tipo", "Data", "Dias", "Nivel"]].reset_index(drop=True)
+
+@medido("dados.alertas")
+def obter_alertas():
+    """Tabela de alertas em cache; só se recalcula quando as Validades mudam, o dia muda ou os limites
+    mudam ([alertas] dias_critico / dias_aviso nos secrets, por omissão 7 e 30 dias)."""
+    dias_critico = int(ler_config("alertas", "dias_critico", 7))
+    dias_aviso = int(ler_config("alertas", "dias_aviso", 30))
+    df_val = carregar_validades()
+    cache = obter_cache_validades()
+    with cache.lock:
+        chave = (cache.versao, datetime.now().date(), dias_critico, dias_aviso)
+        if cache.alertas is None or cache.alertas[0] != chave:
+            tabela = calcular_alertas(df_val, chave[1], dias_critico, dias_aviso) if not df_val.empty else pd.DataFrame(columns=["Matricula", "Tipo", "Data", "Dias", "Nivel"])
+            cache.alertas = (chave, tabela)
+        return cache.alertas[1]
+
+def verificar_alertas(tabela):
+    for a in tabela.itertuples(index=False):
+        if a.Nivel == "expirado": st.error(f"🚨 **URGENTE ({a.Matricula}):** {a.Tipo} expirou dia {a.Data.strftime('%d/%m')}!")
+        elif a.Nivel == "critico": st.error(f"⏰ **CRÍTICO ({a.Matricula}):** {a.Tipo} vence em {a.Dias} dias")
+        else: st.warning(f"⚠️ **Atenção ({a.Matricula}):** {a.Tipo} vence em {a.Dias} dias")
+
+# --- 14. APP PRINCIPAL ---
+telemetria = obter_telemetria()
+execucao = telemetria.nova_execucao()
 if 'logado' not in st.session_state: st.session_state['logado'] = False
 if 'preco_gasoleo_memoria' not in st.session_state: st.session_state['preco_gasoleo_memoria'] = 1.500
 
@@ -169,16 +2080,32 @@ if not st.session_state['logado']:
         mostrar_logo()
         senha = st.text_input("Senha", type="password")
         if st.button("Entrar", type="primary", use_container_width=True):
-            if senha == "queijo123": st.session_state['logado'] = True; st.rerun()
+            # [instrumentacao] senha_admin nos secrets: a mesma app, mais o painel de desempenho
+            senha_admin = ler_config("instrumentacao", "senha_admin")
+            if senha_admin and senha == senha_admin: st.session_state['logado'] = st.session_state['admin'] = True; st.rerun()
+            elif senha == "queijo123": st.session_state['logado'] = True; st.rerun()
             else: st.error("Senha errada!")
 else:
+    telemetria.etapa("barra_lateral")
     with st.sidebar:
         mostrar_logo()
         st.write("---")
-        if st.button("Sair"): st.session_state['logado'] = False; st.rerun()
+        if st.button("Sair"): st.session_state['logado'] = st.session_state['admin'] = False; st.rerun()
+        pendentes, falhadas = estado_escritas()
+        if pendentes: st.caption(f"⏳ {pendentes} escrita(s) à espera de envio para o Google Sheets")
+        if falhadas:
+            st.error(f"❌ {falhadas} escrita(s) não chegaram ao Google Sheets.")
+            diario = obter_diario()
+            if diario:
+                if diario.ultimo_erro(): st.caption(diario.ultimo_erro())
+                c_rep, c_desc = st.columns(2)
+                if c_rep.button("🔁 Repetir"): diario.repetir_falhadas(); st.rerun()
+                if c_desc.button("🗑️ Descartar"): diario.descartar_falhadas(); obter_cache_faturas().invalidar(); st.rerun()
+            else: st.caption(f"{obter_backend().conflitos_sinc()[1]} A folha vai ser reescrita a partir da base local.")
 
-    df_alertas = carregar_validades()
-    if not df_alertas.empty: verificar_alertas(df_alertas)
+    telemetria.etapa("arranque")
+    carregar_arranque()
+    verificar_alertas(obter_alertas())
 
     st.title("🚛 Gestão de Frota")
     menu = st.radio("", ["➕ Adicionar Despesa", "📊 Resumo Financeiro", "📅 Validades & Alertas"], horizontal=True)
@@ -186,11 +2113,12 @@ else:
 
     # --- CONTEÚDO 1: ADICIONAR (LAYOUT ARRUMADO) ---
     if menu == "➕ Adicionar Despesa":
+        telemetria.etapa("adicionar")
         
         # LINHA 1: Categoria, Data, Documento
         col_cat, col_dt, col_nf = st.columns([2, 1, 1])
         with col_cat: 
-            cat = st.selectbox("Categoria", ["Combustível", "Pneus", "Oficina", "Frio", "Lavagem", "Portagens", "Seguro", "Inspeção", "IUC"])
+            cat = st.selectbox("Categoria", CATEGORIAS)
         with col_dt: 
             dt = st.date_input("Data Fatura", datetime.now())
         with col_nf: 
@@ -283,146 +2211,164 @@ else:
         
         # BOTÃO GRAVAR
         if st.button("💾 Gravar", type="primary", use_container_width=True):
-            df_atual = carregar_dados()
-            duplicada = False
-            if nf and not df_atual.empty and nf in df_atual['Num_Fatura'].values:
-                duplicada = True
-                
-            if duplicada:
+            if nf and fatura_existe(nf):
                 st.error(f"🛑 ERRO: A fatura nº **{nf}** já foi registada! Não foi guardada para evitar duplicados.")
             else:
                 val_para_gravar = f"{val:.2f}".replace('.', ',')
+                # Combustível guarda também Litros, Preço/L e AdBlue em colunas próprias (não só na descrição)
+                extras = [f"{val_litros:.2f}".replace('.', ','), f"{preco_litro:.3f}".replace('.', ','), f"{val_adblue:.2f}".replace('.', ',')] if cat == "Combustível" else []
 
                 if cat == "Lavagem":
                     if not mat: st.warning("⚠️ Escolhe pelo menos uma viatura.")
                     elif val <= 0: st.warning("⚠️ O valor tem de ser maior que 0.")
                     else:
-                        sucesso = True
-                        for viatura in mat:
-                            if not guardar_registo([str(dt), viatura, cat, val_para_gravar, km, nf, desc]): sucesso = False
-                        if sucesso:
+                        if guardar_registos([[str(dt), viatura, cat, val_para_gravar, km, nf, desc] for viatura in mat]):
                             st.success(f"✅ {len(mat)} lavagens registadas com sucesso!")
                             st.rerun()
-                        else: st.error("Erro a gravar.")
+                        else: st.error("Erro a gravar. Nenhuma lavagem foi registada.")
                 else:
                     if val > 0 and nf:
                         if cat == "Combustível": st.session_state['preco_gasoleo_memoria'] = preco_litro
-                        if guardar_registo([str(dt), mat, cat, val_para_gravar, km, nf, desc]):
+                        if guardar_registo([str(dt), mat, cat, val_para_gravar, km, nf, desc] + extras):
                             st.success("✅ Fatura registada!")
                             st.rerun()
+                        elif fatura_existe(nf): st.error(f"🛑 ERRO: A fatura nº **{nf}** acabou de ser registada por outro utilizador! Não foi guardada.")
+                        else: st.error("Erro a gravar.")
                     else: st.warning("⚠️ Preenche Valor e Nº Fatura")
 
+        st.write("")
+        with st.expander("📥 Importar Extrato (Cartão de Combustível, Via Verde...)"):
+            ficheiro = st.file_uploader("Ficheiro CSV ou Excel", type=["csv", "txt", "xlsx", "xlsm"])
+            colunas = []
+            if ficheiro:
+                try: colunas = list(next(ler_extrato(ficheiro, bloco=5))[0].columns)
+                except Exception as e: st.error(f"Não foi possível ler o ficheiro: {e}")
+            if colunas:
+                sugestao = adivinhar_mapeamento(colunas)
+                st.caption("Coluna do ficheiro para cada campo (— = o ficheiro não tem):")
+                mapeamento, c_map = {}, st.columns(5)
+                for i, campo in enumerate(CAMPOS_IMPORTACAO):
+                    opcoes = ["—"] + colunas
+                    escolha = c_map[i % 5].selectbox(campo, opcoes, index=opcoes.index(sugestao[campo]) if campo in sugestao else 0, key=f"importar_{campo}")
+                    if escolha != "—": mapeamento[campo] = escolha
+                opcoes_cat = ["Da coluna Categoria"] + CATEGORIAS
+                cat_imp = st.selectbox("Categoria das linhas:", opcoes_cat, index=0 if "Categoria" in mapeamento else 1)
+
+                c_imp1, c_imp2 = st.columns(2)
+                simular = c_imp1.button("👁️ Pré-visualizar (sem gravar)", use_container_width=True)
+                importar = c_imp2.button("📥 Importar", type="primary", use_container_width=True)
+                if simular or importar:
+                    barra = st.progress(0.0, text="A ler o extrato...")
+                    verbo = "por gravar" if simular else "gravadas"
+                    progresso = lambda fracao, r: barra.progress(fracao, text=f"{r['lidas']} linhas lidas · {r['gravadas']} {verbo}")
+                    try: r = importar_extrato(ficheiro, mapeamento, None if cat_imp == opcoes_cat[0] else cat_imp, simular=simular, ao_progredir=progresso)
+                    except Exception as e: r = None; st.error(f"Erro a importar: {e}")
+                    if r:
+                        barra.progress(1.0, text="Concluído")
+                        if r["erro"]: st.error(r["erro"])
+                        (st.info if simular else st.success)(f"{r['lidas']} linhas lidas · {r['gravadas']} {verbo} · {r['duplicadas']} já registadas ou repetidas · {r['rejeitadas']} rejeitadas")
+                        if r["previsao"]:
+                            st.caption(f"Primeiras {len(r['previsao'])} linhas tal como seriam gravadas:")
+                            st.dataframe(pd.DataFrame(r["previsao"]), use_container_width=True, hide_index=True)
+                        if r["rejeitadas"]:
+                            st.warning("Rejeitadas: " + ", ".join(f"{m} ({n})" for m, n in r["motivos"].most_common()))
+                            st.dataframe(pd.DataFrame(r["exemplos"]), use_container_width=True, hide_index=True)
+
     # --- CONTEÚDO 2: RESUMO FINANCEIRO ---
     elif menu == "📊 Resumo Financeiro":
-        df = carregar_dados()
-        if not df.empty:
+        telemetria.etapa("resumo.dados")
+        df = carregar_faturas_tipadas()
+        anos_arq = anos_arquivados()
+        # Logo depois de arquivar (ex.: em janeiro) a folha principal pode estar vazia e o arquivo não
+        if df.empty and anos_arq: df = tipar_faturas(pd.DataFrame(columns=COLUNAS_FATURAS))
+        if not df.empty or anos_arq:
             
-            faturas_contagem = df[df['Num_Fatura'] != ""]['Num_Fatura'].value_counts()
-            duplicados_lista = faturas_contagem[faturas_contagem > 1].index.tolist()
+            duplicados_lista = faturas_duplicadas()
             
             if duplicados_lista:
                 st.error("🚨 **ATENÇÃO: Foram detetadas faturas duplicadas no sistema!**")
                 st.write(f"Nºs de Fatura em duplicado: **{', '.join(duplicados_lista)}** (Usa a ferramenta Editar/Apagar abaixo para corrigir)")
-            
-            def limpar_valor_definitivo(row):
-                v = row.get('Valor', '0')
-                try:
-                    if pd.isna(v) or v == "": return 0.0
-                    v_str = str(v).replace('€', '').strip().replace(' ', '')
-                    if '.' in v_str and ',' in v_str: v_str = v_str.replace('.', '').replace(',', '.')
-                    elif ',' in v_str: v_str = v_str.replace(',', '.')
-                    return float(v_str)
-                except: return 0.0
-
-            df['Valor'] = df.apply(limpar_valor_definitivo, axis=1)
-            df['Valor_Visual'] = df['Valor'].apply(lambda x: f"{x:,.2f} €".replace(",", "X").replace(".", ",").replace("X", "."))
-            df['Data_Fatura'] = pd.to_datetime(df['Data_Fatura'], errors='coerce')
-            df['KM_Atuais'] = pd.to_numeric(df['KM_Atuais'], errors='coerce').fillna(0).astype(int)
-            df = df.dropna(subset=['Data_Fatura']) 
-            
-            def extrair_litros(desc):
-                try:
-                    if "Litros:" in str(desc): return float(str(desc).split("Litros:")[1].split("|")[0].strip().replace(',', '.'))
-                except: pass
-                return 0.0
-            
-            df['Litros'] = df['Descricao'].apply(extrair_litros)
 
             with st.expander("🔍 Configurar Filtros", expanded=True):
-                df['Ano'] = df['Data_Fatura'].dt.year.astype(int)
-                df['Mês'] = df['Data_Fatura'].dt.month.astype(int)
-                
                 c_ano, c_mes, c_doc = st.columns(3)
-                lista_anos = ["Todos"] + sorted(list(df['Ano'].unique()), reverse=True)
-                f_ano = c_ano.selectbox("Ano:", lista_anos)
+                lista_anos = ["Todos"] + sorted(set(df['Ano'].unique()) | set(anos_arq), reverse=True)
+                # Com anos arquivados abre no ano mais recente: os outros (e "Todos") só se leem quando escolhidos
+                f_ano = c_ano.selectbox("Ano:", lista_anos, index=1 if anos_arq else 0)
+                anos_pedidos = anos_arq if f_ano == "Todos" else [a for a in anos_arq if a == f_ano]
+                try: df_ver = faturas_visiveis(anos_pedidos)
+                except Exception as e:
+                    telemetria.erro("resumo.arquivo", e)
+                    st.error("Não foi possível carregar as faturas arquivadas desse ano.")
+                    anos_pedidos, df_ver = [], df
                 
-                meses_dict = {1:"Jan", 2:"Fev", 3:"Mar", 4:"Abr", 5:"Mai", 6:"Jun", 7:"Jul", 8:"Ago", 9:"Set", 10:"Out", 11:"Nov", 12:"Dez"}
-                df['Nome_Mês'] = df['Mês'].map(meses_dict)
-                
-                lista_meses = ["Todos"] + list(meses_dict.values())
+                lista_meses = ["Todos"] + list(MESES_PT.values())
                 f_mes = c_mes.selectbox("Mês:", lista_meses)
                 f_doc = c_doc.text_input("Nº Fatura:")
                 
                 c_mat, c_cat = st.columns(2)
-                f_mats = c_mat.multiselect("Viaturas:", sorted(df["Matricula"].unique()))
-                f_cats = c_cat.multiselect("Categorias:", sorted(df["Categoria"].unique()))
+                f_mats = c_mat.multiselect("Viaturas:", sorted(df_ver["Matricula"].unique()))
+                f_cats = c_cat.multiselect("Categorias:", sorted(df_ver["Categoria"].unique()))
 
-            df_f = df.copy()
-            if f_ano != "Todos": df_f = df_f[df_f['Ano'] == f_ano]
-            if f_mes != "Todos": df_f = df_f[df_f['Nome_Mês'] == f_mes]
-            if f_mats: df_f = df_f[df_f["Matricula"].isin(f_mats)]
-            if f_cats: df_f = df_f[df_f["Categoria"].isin(f_cats)]
-            if f_doc: df_f = df_f[df_f["Num_Fatura"].astype(str).str.contains(f_doc, case=False)]
+            telemetria.etapa("resumo.filtros")
+            n_ano = None if f_ano == "Todos" else f_ano
+            n_mes = None if f_mes == "Todos" else list(MESES_PT.values()).index(f_mes) + 1
+            filtros = (n_ano, n_mes, tuple(sorted(f_mats)), tuple(sorted(f_cats)), f_doc.strip().lower())
+            df_f = filtrar_faturas(ano=n_ano, mes=n_mes, matriculas=f_mats, categorias=f_cats, doc=f_doc, anos_arquivo=anos_pedidos)
 
             if not df_f.empty:
                 st.divider()
+                telemetria.etapa("resumo.tabela")
                 st.subheader("📊 Resumo por Viatura e Mês")
-                pivot = pd.pivot_table(df_f, values='Valor', index='Matricula', columns='Nome_Mês', aggfunc='sum', fill_value=0)
-                meses_ordem = ['Jan', 'Fev', 'Mar', 'Abr', 'Mai', 'Jun', 'Jul', 'Ago', 'Set', 'Out', 'Nov', 'Dez']
-                cols = [m for m in meses_ordem if m in pivot.columns]
-                pivot = pivot[cols]
+                # Totais já agregados por ano/mês/viatura/categoria; com pesquisa por Nº de fatura agrega-se o filtrado
+                if f_doc: agg = RollupMensal.agregar(df_f).reset_index()
+                else: agg = rollup_filtrado(ano=n_ano, mes=n_mes, matriculas=f_mats, categorias=f_cats, anos_arquivo=anos_pedidos)
+                
+                pivot = agg.pivot_table(values='Valor', index='Matricula', columns=['Ano', 'Mês'], aggfunc='sum', fill_value=0).sort_index(axis=1)
+                # Com "Todos" os anos, cada coluna é mês + ano (Jan 2024 e Jan 2025 não se somam)
+                pivot.columns = [MESES_PT[m] if f_ano != "Todos" else f"{MESES_PT[m]} {a}" for a, m in pivot.columns]
                 
                 pivot['Total Gasto'] = pivot.sum(axis=1)
                 pivot = pivot.sort_values('Total Gasto', ascending=False)
-                for col in pivot.columns: pivot[col] = pivot[col].apply(lambda x: f"{x:,.2f} €".replace(",", "X").replace(".", ",").replace("X", "."))
+                for col in pivot.columns: pivot[col] = formatar_euros(pivot[col])
                 st.dataframe(pivot, use_container_width=True)
 
+                telemetria.etapa("resumo.graficos")
                 st.write("---")
+                graficos = obter_graficos_resumo(filtros, agg, df_f, anos_pedidos)
                 col_g1, col_g2 = st.columns(2)
-                df_ev = df_f.groupby([df_f['Data_Fatura'].dt.to_period('M').astype(str), 'Categoria'])['Valor'].sum().reset_index()
-                df_ev.columns = ['Mês', 'Categoria', 'Valor'] 
-                
-                fig_bar_stack = px.bar(df_ev, x='Mês', y='Valor', color='Categoria', title="Evolução Mensal (Por Categoria)", text_auto='.2s')
-                col_g1.plotly_chart(fig_bar_stack, use_container_width=True)
-                
-                fig_pie = px.pie(df_f, values='Valor', names='Categoria', title="Distribuição de Custos", hole=0.4)
-                col_g2.plotly_chart(fig_pie, use_container_width=True)
+                col_g1.plotly_chart(graficos["evolucao"], use_container_width=True)
+                col_g2.plotly_chart(graficos["distribuicao"], use_container_width=True)
 
                 st.divider()
                 
+                telemetria.etapa("resumo.editar")
                 with st.expander("🛠️ Editar ou Apagar Fatura"):
+                    if anos_arq: st.caption(f"Só se editam as faturas da folha principal; os anos arquivados ({', '.join(map(str, anos_arq))}) são só de consulta.")
                     c_del1, c_del2 = st.columns(2)
                     l_mat_del = ["Todas"] + list(df["Matricula"].unique())
                     f_mat_del = c_del1.selectbox("Viatura (Procurar):", l_mat_del)
-                    f_doc_del = c_del2.text_input("Nº Fatura (Procurar):")
+                    f_doc_del = c_del2.text_input("Nº Fatura ou Matrícula (Procurar):")
                     
-                    df_del = df.copy(); df_del['Idx'] = df_del.index
-                    if f_mat_del != "Todas": df_del = df_del[df_del["Matricula"] == f_mat_del]
-                    if f_doc_del: df_del = df_del[df_del["Num_Fatura"].astype(str).str.contains(f_doc_del, case=False)]
+                    lida = st.session_state.get('fatura_lida')  # (ID, Versao) que estava no formulário antes deste clique
+                    idx_del = pesquisar_faturas(f_doc_del)
+                    if f_mat_del != "Todas": idx_del = idx_del[(df.loc[idx_del, "Matricula"] == f_mat_del).to_numpy()]
                     
-                    if not df_del.empty:
-                        ops = [f"Linha {r.Idx} | {r.Data_Fatura.date()} | {r.Matricula} | Fatura: {r.Num_Fatura} | {r.Valor_Visual}" for _, r in df_del.iterrows()]
-                        escolha = st.selectbox("Selecionar Fatura:", ops[::-1])
-                        
-                        idx_escolhido = int(escolha.split(" |")[0].replace("Linha ", ""))
-                        dados_linha = df_del[df_del['Idx'] == idx_escolhido].iloc[0]
+                    if len(idx_del):
+                        # Só a página escolhida é que ganha rótulos e vai para o browser
+                        pag = df.loc[pagina_de(idx_del, "pag_editar")]
+                        rotulos = ("Linha " + pag.index.astype(str) + " | " + pag["Data_Fatura"].dt.date.astype(str) + " | " + pag["Matricula"].astype(str) + " | Fatura: " + pag["Num_Fatura"].astype(str) + " | " + pag["Valor_Visual"])
+                        rotulos = dict(zip(rotulos, pag.index))
+                        idx_escolhido = rotulos[st.selectbox("Selecionar Fatura:", list(rotulos))]
+                        dados_linha = df.loc[idx_escolhido]
+                        atual = (str(dados_linha['ID_Fatura']), _num_versao(dados_linha['Versao']))
+                        aviso_conflito = "🛑 Esta fatura foi alterada ou apagada por outra pessoa entretanto. Confirma os dados atualizados e tenta de novo."
                         
                         st.write("---")
                         st.markdown("##### ✏️ Editar Dados da Fatura")
                         e_c1, e_c2, e_c3 = st.columns(3)
                         n_data = e_c1.date_input("Nova Data", dados_linha['Data_Fatura'])
                         n_mat = e_c2.selectbox("Nova Viatura", LISTA_VIATURAS, index=LISTA_VIATURAS.index(dados_linha['Matricula']) if dados_linha['Matricula'] in LISTA_VIATURAS else 0)
-                        n_cat = e_c3.selectbox("Nova Categoria", ["Combustível", "Pneus", "Oficina", "Frio", "Lavagem", "Portagens", "Seguro", "Inspeção", "IUC"], index=["Combustível", "Pneus", "Oficina", "Frio", "Lavagem", "Portagens", "Seguro", "Inspeção", "IUC"].index(dados_linha['Categoria']) if dados_linha['Categoria'] in ["Combustível", "Pneus", "Oficina", "Frio", "Lavagem", "Portagens", "Seguro", "Inspeção", "IUC"] else 0)
+                        n_cat = e_c3.selectbox("Nova Categoria", CATEGORIAS, index=CATEGORIAS.index(dados_linha['Categoria']) if dados_linha['Categoria'] in CATEGORIAS else 0)
                         
                         e_k1, e_k2, e_k3 = st.columns(3)
                         n_val = e_k1.number_input("Novo Valor (€)", value=float(dados_linha['Valor']), step=0.01)
@@ -434,18 +2380,28 @@ else:
                         col_btn1, col_btn2 = st.columns(2)
                         if col_btn1.button("💾 Guardar Alterações", type="primary", use_container_width=True):
                             n_val_str = f"{n_val:.2f}".replace('.', ',')
-                            if editar_registo(idx_escolhido, [str(n_data), n_mat, n_cat, n_val_str, n_km, n_nf, n_desc]):
+                            if lida != atual: st.error(aviso_conflito)
+                            elif n_nf and n_nf != str(dados_linha['Num_Fatura']) and fatura_existe(n_nf):
+                                st.error(f"🛑 ERRO: A fatura nº **{n_nf}** já existe noutra linha!")
+                            elif editar_registo(*atual, [str(n_data), n_mat, n_cat, n_val_str, n_km, n_nf, n_desc]):
                                 st.success("✅ Fatura atualizada com sucesso!")
                                 st.rerun()
+                            elif not fatura_em_dia(*atual): st.error(aviso_conflito)
                             else: st.error("Erro ao atualizar fatura.")
                                 
                         if col_btn2.button("❌ Eliminar Fatura", use_container_width=True):
-                            if eliminar_registo(idx_escolhido): 
+                            if lida != atual: st.error(aviso_conflito)
+                            elif eliminar_registo(*atual): 
                                 st.success("✅ Fatura eliminada!")
                                 st.rerun()
+                            elif not fatura_em_dia(*atual): st.error(aviso_conflito)
+                            else: st.error("Erro ao eliminar fatura.")
+                        st.session_state['fatura_lida'] = atual
 
+                telemetria.etapa("resumo.detalhe")
                 st.subheader("📋 Detalhe das Faturas (Filtradas)")
-                st.dataframe(df_f, use_container_width=True, hide_index=True,
+                st.caption(f"{len(df_f)} fatura(s), as mais recentes primeiro")
+                st.dataframe(df_f.loc[pagina_de(df_f.index, "pag_detalhe")], use_container_width=True, hide_index=True,
                     column_order=["Data_Fatura", "Matricula", "Categoria", "Valor_Visual", "KM_Atuais", "Num_Fatura", "Descricao"],
                     column_config={
                         "Matricula": st.column_config.TextColumn("Viatura"),
@@ -459,40 +2415,45 @@ else:
                 )
 
                 st.divider()
+                telemetria.etapa("resumo.graficos_viaturas")
                 st.subheader("📈 Custo Total por Viatura (Detalhado)")
-                df_grafico_final = df_f.groupby(['Matricula', 'Categoria'])['Valor'].sum().reset_index()
-                fig_final = px.bar(df_grafico_final, y='Matricula', x='Valor', color='Categoria', orientation='h', title="Despesas por Viatura divididas por Categoria", text_auto='.2s')
-                fig_final.update_layout(yaxis={'categoryorder':'total ascending'}, xaxis_title="Total Gasto (€)", yaxis_title="Viatura", height=600)
-                st.plotly_chart(fig_final, use_container_width=True)
+                st.plotly_chart(graficos["viaturas"], use_container_width=True)
                 
                 st.divider()
+                telemetria.etapa("resumo.consumos")
                 st.subheader("⛽ Análise de Consumos Médios (L/100km)")
-                df_comb = df_f[df_f['Categoria'] == 'Combustível'].copy()
-                dados_consumo = []
-                for mat in df_comb['Matricula'].unique():
-                    df_v = df_comb[(df_comb['Matricula'] == mat) & (df_comb['KM_Atuais'] > 0) & (df_comb['Litros'] > 0)].sort_values('KM_Atuais')
-                    if len(df_v) > 1:
-                        dist = df_v['KM_Atuais'].max() - df_v['KM_Atuais'].min()
-                        litros_gastos = df_v['Litros'].iloc[1:].sum() 
-                        if dist > 0 and litros_gastos > 0:
-                            media = (litros_gastos / dist) * 100
-                            if 0 < media < 100: 
-                                dados_consumo.append({'Matricula': mat, 'Média (L/100km)': round(media, 2), 'KMs Percorridos': dist, 'Litros Consumidos': round(litros_gastos, 2)})
+                df_cons = graficos["consumos"]
                 
-                if dados_consumo:
-                    df_cons = pd.DataFrame(dados_consumo).sort_values('Média (L/100km)', ascending=False)
+                if not df_cons.empty:
                     c_cons1, c_cons2 = st.columns([2, 1])
-                    fig_cons = px.bar(df_cons, x='Média (L/100km)', y='Matricula', orientation='h', title="Viaturas Mais Gulosas (Média de Litros por 100km)", text_auto=True, color='Média (L/100km)', color_continuous_scale='Reds')
-                    fig_cons.update_layout(yaxis={'categoryorder':'total ascending'})
-                    c_cons1.plotly_chart(fig_cons, use_container_width=True)
+                    c_cons1.plotly_chart(graficos["fig_consumos"], use_container_width=True)
                     c_cons2.dataframe(df_cons[['Matricula', 'Média (L/100km)', 'KMs Percorridos']], use_container_width=True, hide_index=True)
+
+                    if "tendencia" in graficos: st.plotly_chart(graficos["tendencia"], use_container_width=True)
                 else:
                     st.info("💡 Não há registos de abastecimento suficientes no período selecionado para calcular médias reais.")
 
+                anomalias = graficos["anomalias"]
+                if not anomalias.empty:
+                    with st.expander(f"🚩 Abastecimentos Suspeitos ({len(anomalias)})"):
+                        st.dataframe(anomalias, use_container_width=True, hide_index=True,
+                            column_order=["Data_Fatura", "Matricula", "KM_Atuais", "KMs", "Litros", "L100", "L100_Movel", "Anomalia"],
+                            column_config={
+                                "Data_Fatura": st.column_config.DateColumn("Data", format="DD/MM/YYYY"),
+                                "Matricula": st.column_config.TextColumn("Viatura"),
+                                "KM_Atuais": st.column_config.NumberColumn("KMs", format="%d km"),
+                                "KMs": st.column_config.NumberColumn("KMs Percorridos", format="%d km"),
+                                "L100": st.column_config.NumberColumn("L/100km"),
+                                "L100_Movel": st.column_config.NumberColumn("Média Móvel"),
+                                "Anomalia": st.column_config.TextColumn("Motivo")
+                            }
+                        )
+
             else: st.warning("Sem dados para os filtros selecionados.")
 
     # --- CONTEÚDO 3: VALIDADES ---
     elif menu == "📅 Validades & Alertas":
+        telemetria.etapa("validades")
         st.subheader("Controlo de Prazos")
         st.info("ℹ️ Para **APAGAR** uma data, limpa o campo (deixa vazio) e clica em Atualizar.")
         
@@ -514,6 +2475,53 @@ else:
                         st.rerun() 
                     else: st.error("Erro.")
 
+        with st.expander("🗂️ Atualizar Várias Viaturas"):
+            with st.form("form_validades_bloco"):
+                st.caption("Ex.: renovação do seguro de toda a frota. Todas as viaturas escolhidas vão numa só escrita.")
+                b_mats = st.multiselect("Viaturas:", LISTA_VIATURAS, default=LISTA_VIATURAS)
+                c_b1, c_b2 = st.columns(2)
+                b_tipo = c_b1.selectbox("Prazo:", list(PRAZOS_VALIDADES))
+                b_data = c_b2.date_input("Nova Data", value=None)
+                
+                if st.form_submit_button("Aplicar às Viaturas Escolhidas", type="primary", use_container_width=True):
+                    base = carregar_validades()
+                    if not b_mats or not b_data or base.empty: st.warning("⚠️ Escolhe as viaturas e a data.")
+                    else:
+                        base = base.set_index("Matricula")
+                        base.loc[b_mats, PRAZOS_VALIDADES[b_tipo]] = str(b_data)
+                        if guardar_validades_novas(base.loc[b_mats].reset_index()[COLUNAS_VALIDADES].values.tolist()):
+                            st.success(f"✅ {b_tipo} atualizado em {len(b_mats)} viatura(s)!")
+                            st.rerun()
+                        else: st.error("Erro.")
+            
+            st.write("---")
+            st.markdown("##### ✏️ Editar a Tabela")
+            df_tab = carregar_validades()
+            if not df_tab.empty:
+                df_tab = df_tab[COLUNAS_VALIDADES].astype(str)
+                df_ed = df_tab.copy()
+                for c in PRAZOS_VALIDADES.values(): df_ed[c] = pd.to_datetime(df_ed[c].str.strip(), format="%Y-%m-%d", errors="coerce").dt.date
+                editado = st.data_editor(df_ed, use_container_width=True, hide_index=True, disabled=["Matricula"], key="editor_validades",
+                    column_config={
+                        "Matricula": st.column_config.TextColumn("Viatura", width="small"),
+                        "Data_Seguro": st.column_config.DateColumn("Seguro", format="DD/MM/YYYY"),
+                        "Data_Inspecao": st.column_config.DateColumn("Inspeção", format="DD/MM/YYYY"),
+                        "Data_IUC": st.column_config.DateColumn("IUC", format="DD/MM/YYYY"),
+                        "Observacoes": st.column_config.TextColumn("Notas")
+                    }
+                )
+                if st.button("💾 Guardar Tabela", use_container_width=True):
+                    texto = lambda col: col.map(lambda v: "" if pd.isna(v) else str(v))
+                    antes, depois = df_ed.apply(texto), editado.apply(texto)
+                    # Células não mexidas ficam com o texto original (mesmo que não seja uma data que se leia)
+                    final = depois.where(antes != depois, df_tab)
+                    mudadas = (antes != depois).any(axis=1)
+                    if not mudadas.any(): st.info("Nada para guardar.")
+                    elif guardar_validades_novas(final[mudadas].values.tolist()):
+                        st.success(f"✅ {int(mudadas.sum())} viatura(s) atualizadas!")
+                        st.rerun()
+                    else: st.error("Erro.")
+
         st.divider()
         st.subheader("📋 Estado Geral da Frota")
         df_vals = carregar_validades()
@@ -527,3 +2535,9 @@ else:
                     "Observacoes": st.column_config.TextColumn("Notas")
                 }
             )
+
+    telemetria.etapa(None)
+    if st.session_state.get('admin'):
+        with st.sidebar:
+            painel_desempenho(execucao)
+            painel_arquivo()
@@ -0,0 +1,368 @@
+"""Benchmark offline da app: corre o app.py sem rede, contra um Google Sheets em memória.
+
+Gera um histórico sintético de faturas (todas as viaturas de LISTA_VIATURAS e todas as categorias)
+e mede, página a página, o tempo, a memória e os pedidos que seriam feitos à API do Google.
+
+    python benchmark.py                       # 1k, 100k e 1M linhas
+    python benchmark.py --linhas 1000 100000  # só alguns tamanhos
+    python benchmark.py --latencia-ms 150     # simula a ida e volta de cada pedido ao Google
+    python benchmark.py --saida bench_output.txt
+"""
+import argparse
+import ast
+import gc
+import os
+import random
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from datetime import date, timedelta
+
+import gspread
+import streamlit as st
+from oauth2client.service_account import ServiceAccountCredentials
+from streamlit.testing.v1 import AppTest
+
+PASTA = os.path.dirname(os.path.abspath(__file__))
+CAMINHO_APP = os.path.join(PASTA, "app.py")
+
+def constante_app(nome):
+    """Constante (uma lista literal) lida do app.py sem o importar (importar corria a app toda)."""
+    with open(CAMINHO_APP, encoding="utf-8") as f: arvore = ast.parse(f.read())
+    for no in arvore.body:
+        if isinstance(no, ast.Assign) and any(getattr(a, "id", None) == nome for a in no.targets):
+            return ast.literal_eval(no.value)
+    raise RuntimeError(f"{nome} não encontrada no app.py")
+
+CATEGORIAS = constante_app("CATEGORIAS")
+PESOS_CATEGORIAS = {"Combustível": 50, "Pneus": 4, "Oficina": 10, "Frio": 4, "Lavagem": 8, "Portagens": 16, "Seguro": 3, "Inspeção": 3, "IUC": 2}  # o gasóleo domina, como na frota real
+CABECALHO_FATURAS = constante_app("COLUNAS_FATURAS")
+CABECALHO_VALIDADES = constante_app("COLUNAS_VALIDADES")
+ANOS_HISTORICO = 5
+
+# --- 1. GOOGLE SHEETS EM MEMÓRIA ---
+# Só a parte da API do gspread que a app usa. Cada chamada conta como um pedido ao Google
+# e, com --latencia-ms, espera o tempo de uma ida e volta.
+class ContadorPedidos:
+    def __init__(self, latencia=0.0):
+        self.latencia = latencia
+        self.pedidos = Counter()
+
+    def registar(self, metodo):
+        self.pedidos[metodo] += 1
+        if self.latencia: time.sleep(self.latencia)
+
+    def recolher(self):
+        pedidos, self.pedidos = self.pedidos, Counter()
+        return pedidos
+
+def _coluna_num(letras):
+    n = 0
+    for c in letras: n = n * 26 + ord(c) - 64
+    return n
+
+def _aparar(linhas):
+    """Como a API do Google: sem as células vazias no fim de cada linha nem as linhas vazias no fim."""
+    linhas = [list(l) for l in linhas]
+    for l in linhas:
+        while l and l[-1] == "": l.pop()
+    while linhas and not linhas[-1]: linhas.pop()
+    return linhas
+
+def _intervalo(a1):
+    """'B2:E10' -> (col1, linha1, col2, linha2); linha2 None quando o intervalo vai até ao fim."""
+    m = re.match(r"([A-Z]+)(\d*)(?::([A-Z]+)(\d*))?$", a1)
+    c1, l1, c2, l2 = m.groups()
+    return _coluna_num(c1), int(l1) if l1 else 1, _coluna_num(c2 or c1), int(l2) if l2 else None
+
+class FolhaFalsa:
+    def __init__(self, titulo, linhas, contador):
+        self.title = titulo
+        self.linhas = linhas
+        self.contador = contador
+
+    @property
+    def row_count(self): return len(self.linhas) + 1000
+
+    def _ler(self, a1):
+        c1, l1, c2, l2 = _intervalo(a1)
+        return _aparar(l[c1 - 1:c2] for l in self.linhas[l1 - 1:l2 or len(self.linhas)])
+
+    def _escrever(self, a1, valores):
+        c1, l1 = _intervalo(a1)[:2]
+        for k, valor in enumerate(valores):
+            while len(self.linhas) < l1 + k: self.linhas.append([])
+            linha = self.linhas[l1 + k - 1]
+            if len(linha) < c1 - 1 + len(valor): linha.extend([""] * (c1 - 1 + len(valor) - len(linha)))
+            for j, x in enumerate(valor): linha[c1 - 1 + j] = str(x)
+
+    def get_all_values(self, **k):
+        self.contador.registar("get_all_values")
+        return [list(l) for l in self.linhas]
+
+    def get_all_records(self, **k):
+        self.contador.registar("get_all_records")
+        if not self.linhas: return []
+        cab = self.linhas[0]
+        return [dict(zip(cab, l + [""] * (len(cab) - len(l)))) for l in self.linhas[1:]]
+
+    def get(self, a1, **k):
+        self.contador.registar("get")
+        return self._ler(a1)
+
+    def batch_get(self, intervalos, **k):
+        self.contador.registar("batch_get")
+        return [self._ler(a1) for a1 in intervalos]
+
+    def row_values(self, n, **k):
+        self.contador.registar("row_values")
+        return list(self.linhas[n - 1]) if len(self.linhas) >= n else []
+
+    def col_values(self, n, **k):
+        self.contador.registar("col_values")
+        return [l[n - 1] if len(l) >= n else "" for l in self.linhas]
+
+    def append_row(self, valores, **k):
+        self.contador.registar("append_row")
+        self.linhas.append([str(x) for x in valores])
+
+    def append_rows(self, valores, **k):
+        self.contador.registar("append_rows")
+        self.linhas.extend([str(x) for x in v] for v in valores)
+
+    def update(self, range_name=None, values=None, **k):
+        self.contador.registar("update")
+        if isinstance(range_name, list): range_name, values = values, range_name  # update(valores, a1) do gspread 6
+        self._escrever(range_name or "A1", values)
+
+    def batch_update(self, dados, **k):
+        self.contador.registar("batch_update")
+        for d in dados: self._escrever(d["range"], d["values"])
+
+    def delete_rows(self, inicio, fim=None):
+        self.contador.registar("delete_rows")
+        del self.linhas[inicio - 1:fim or inicio]
+
+class LivroFalso:
+    def __init__(self, folhas, contador):
+        self.folhas = folhas
+        self.contador = contador
+
+    def get_worksheet(self, indice):
+        self.contador.registar("get_worksheet")
+        return self.folhas[indice]
+
+    def worksheet(self, titulo):
+        self.contador.registar("worksheet")
+        for f in self.folhas:
+            if f.title == titulo: return f
+        raise gspread.exceptions.WorksheetNotFound(titulo)
+
+    def worksheets(self):
+        self.contador.registar("worksheets")
+        return list(self.folhas)
+
+    def add_worksheet(self, title, rows=1000, cols=26, **k):
+        self.contador.registar("add_worksheet")
+        folha = FolhaFalsa(title, [], self.contador)
+        self.folhas.append(folha)
+        return folha
+
+    def values_batch_get(self, intervalos, **k):
+        self.contador.registar("values_batch_get")
+        blocos = []
+        for intervalo in intervalos:
+            titulo, _, a1 = intervalo.partition("!")
+            folha = next(f for f in self.folhas if f.title == titulo.strip("'").replace("''", "'"))
+            valores = folha._ler(a1) if a1 else _aparar(folha.linhas)
+            blocos.append({"range": intervalo, **({"values": valores} if valores else {})})
+        return {"valueRanges": blocos}
+
+class ClienteFalso:
+    def __init__(self, livro, contador):
+        self.livro = livro
+        self.contador = contador
+
+    def open(self, nome):
+        self.contador.registar("open")
+        return self.livro
+
+class CredenciaisFalsas:
+    access_token_expired = False
+
+def instalar(livro, contador):
+    """Troca a autorização do gspread pelo livro em memória (a app faz import gspread no mesmo processo)."""
+    gspread.authorize = lambda creds: ClienteFalso(livro, contador)
+    ServiceAccountCredentials.from_json_keyfile_dict = staticmethod(lambda dados, scope: CredenciaisFalsas())
+
+# --- 2. DADOS SINTÉTICOS ---
+def gerar_faturas(n_linhas, viaturas, semente=42):
+    """n_linhas faturas ao longo dos últimos ANOS_HISTORICO anos, já com ID_Fatura e Versao."""
+    aleatorio = random.Random(semente)
+    hoje = date.today()
+    dias = ANOS_HISTORICO * 365
+    km = {v: aleatorio.randint(50_000, 400_000) for v in viaturas}
+    datas = sorted(hoje - timedelta(days=aleatorio.randrange(dias)) for _ in range(n_linhas))
+    categorias = aleatorio.choices(CATEGORIAS, weights=[PESOS_CATEGORIAS.get(c, 1) for c in CATEGORIAS], k=n_linhas)
+    linhas = [list(CABECALHO_FATURAS)]
+    for i, (dia, cat) in enumerate(zip(datas, categorias)):
+        mat = aleatorio.choice(viaturas)
+        valor = round(aleatorio.uniform(20, 900), 2)
+        litros = preco = adblue = km_txt = ""
+        desc = ""
+        if cat == "Combustível":
+            km[mat] += aleatorio.randint(300, 1200)
+            km_txt = str(km[mat])
+            preco = round(aleatorio.uniform(1.4, 1.9), 3)
+            litros = round(valor / preco, 2)
+            adblue = round(aleatorio.uniform(0, 30), 2) if aleatorio.random() < 0.2 else ""
+            desc = f"Preço/L: {preco:.3f}€ | Litros: {litros:.2f}"
+        elif cat in ("Oficina", "Frio"):
+            desc = aleatorio.choice(["Revisão", "Reparação", "Discos, Pastilhas", "Avaria"])
+        valor_txt = f"{valor:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+        linhas.append([dia.isoformat(), mat, cat, valor_txt, km_txt, f"FT{dia.year}/{i + 1}", desc,
+                       str(litros), str(preco), str(adblue), f"f{i:011x}", "1"])
+    return linhas
+
+def gerar_validades(viaturas, semente=42):
+    aleatorio = random.Random(semente)
+    hoje = date.today()
+    dia = lambda: (hoje + timedelta(days=aleatorio.randint(-10, 365))).isoformat()
+    return [list(CABECALHO_VALIDADES)] + [[v, dia(), dia(), dia(), ""] for v in viaturas]
+
+# --- 3. MEDIÇÃO ---
+def _rss_pico_mb():
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return pico / 1024 / 1024 if sys.platform == "darwin" else pico / 1024  # bytes no macOS, KB no Linux
+
+class Medicao:
+    def __init__(self, n_linhas, contador):
+        self.n_linhas = n_linhas
+        self.contador = contador
+        self.resultados = []
+
+    def passo(self, nome, acao):
+        """Corre acao() (uma execução do script) e guarda tempo, pico de memória Python e pedidos à API."""
+        gc.collect()
+        self.contador.recolher()
+        tracemalloc.reset_peak()
+        inicio = time.perf_counter()
+        at = acao()
+        segundos = time.perf_counter() - inicio
+        pico = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+        pedidos = self.contador.recolher()
+        erros = [e.value for e in at.exception] if at is not None else []
+        self.resultados.append({"linhas": self.n_linhas, "passo": nome, "segundos": segundos, "pico_mb": pico,
+                                "rss_mb": _rss_pico_mb(), "pedidos": pedidos, "erros": erros})
+        return at
+
+def _widget(lista, rotulo):
+    return next(w for w in lista if w.label.startswith(rotulo))
+
+def _botao(at, rotulo):
+    return next(b for b in at.button if b.label == rotulo)
+
+def correr_tamanho(n_linhas, viaturas, latencia, sincrono, timeout):
+    contador = ContadorPedidos()
+    livro = LivroFalso([FolhaFalsa("Faturas", gerar_faturas(n_linhas, viaturas), contador),
+                        FolhaFalsa("Validades", gerar_validades(viaturas), contador)], contador)
+    instalar(livro, contador)
+    contador.latencia = latencia
+    pasta = tempfile.mkdtemp(prefix="bench_frota_")
+    medicao = Medicao(n_linhas, contador)
+    try:
+        # Recursos partilhados (ligação, caches, diário) de um tamanho anterior não podem passar para este
+        st.cache_resource.clear()
+        st.cache_data.clear()
+
+        at = AppTest.from_file(CAMINHO_APP, default_timeout=timeout)
+        at.secrets["service_account"] = {"type": "service_account"}
+        at.secrets["armazenamento"] = {"escrita_assincrona": not sincrono, "caminho_diario": os.path.join(pasta, "diario.db")}
+        at.session_state["logado"] = True  # a senha só decide o ecrã; o custo está no primeiro arranque depois dela
+
+        medicao.passo("login + alertas (arranque a frio)", at.run)
+        medicao.passo("nova execução (caches quentes)", at.run)
+
+        def gravar(num_fatura):
+            def acao():
+                _widget(at.text_input, "Nº Fatura").set_value(num_fatura)
+                _widget(at.number_input, "Valor Gasóleo").set_value(80.0)
+                _widget(at.number_input, "KMs").set_value(999_999)
+                return _botao(at, "💾 Gravar").click().run()
+            return acao
+        medicao.passo("gravar despesa nova", gravar("BENCH/1"))
+        medicao.passo("gravar despesa duplicada", gravar("BENCH/1"))
+        if not any("já foi registada" in e.value for e in at.error):
+            medicao.resultados[-1]["erros"].append("o duplicado não foi detetado")
+
+        medicao.passo("resumo (sem filtros)", lambda: at.radio[0].set_value("📊 Resumo Financeiro").run())
+        anos = _widget(at.selectbox, "Ano:").options
+        ano = anos[1] if len(anos) > 1 else anos[0]
+        medicao.passo("resumo ano", lambda: _widget(at.selectbox, "Ano:").set_value(ano).run())
+        medicao.passo("resumo ano + mês", lambda: _widget(at.selectbox, "Mês:").set_value(_widget(at.selectbox, "Mês:").options[3]).run())
+        medicao.passo("resumo 3 viaturas", lambda: _widget(at.multiselect, "Viaturas:").set_value(viaturas[:3]).run())
+        medicao.passo("resumo categoria", lambda: _widget(at.multiselect, "Categorias:").set_value(["Combustível"]).run())
+        def limpar():
+            _widget(at.selectbox, "Ano:").set_value("Todos")
+            _widget(at.selectbox, "Mês:").set_value("Todos")
+            _widget(at.multiselect, "Viaturas:").set_value([])
+            _widget(at.multiselect, "Categorias:").set_value([])
+            return _widget(at.text_input, "Nº Fatura:").set_value("FT").run()
+        medicao.passo("resumo pesquisa Nº Fatura", limpar)
+        medicao.passo("validades & alertas", lambda: at.radio[0].set_value("📅 Validades & Alertas").run())
+
+        # Arquivo por ano: o botão só aparece aos administradores; depois o Resumo lê as folhas arquivadas
+        at.session_state["admin"] = True
+        at.run()
+        medicao.passo("arquivar anos fechados", lambda: _botao(at, f"🗄️ Arquivar anos anteriores a {date.today().year}").click().run())
+        if not any("Arquivados:" in s.value for s in at.success):
+            medicao.resultados[-1]["erros"].append("nenhum ano foi arquivado")
+        medicao.passo("resumo (ano corrente, com arquivo)", lambda: at.radio[0].set_value("📊 Resumo Financeiro").run())
+        arquivados = [a for a in _widget(at.selectbox, "Ano:").options if a != "Todos" and int(a) < date.today().year]
+        if arquivados:
+            medicao.passo("resumo ano arquivado", lambda: _widget(at.selectbox, "Ano:").set_value(arquivados[0]).run())
+            medicao.passo("resumo todos os anos", lambda: _widget(at.selectbox, "Ano:").set_value("Todos").run())
+    finally:
+        shutil.rmtree(pasta, ignore_errors=True)
+    return medicao.resultados
+
+# --- 4. RELATÓRIO ---
+def relatorio(resultados, latencia):
+    linhas = [f"Benchmark frota — latência simulada por pedido: {latencia * 1000:.0f} ms", ""]
+    cab = f"{'linhas':>9}  {'passo':<36}{'tempo (s)':>10}{'pico py (MB)':>14}{'RSS máx (MB)':>14}{'pedidos':>9}  detalhe"
+    linhas += [cab, "-" * len(cab)]
+    for r in resultados:
+        detalhe = ", ".join(f"{m}×{n}" for m, n in sorted(r["pedidos"].items()))
+        if r["erros"]: detalhe += f"  ERRO: {r['erros'][0][:80]}"
+        linhas.append(f"{r['linhas']:>9}  {r['passo']:<36}{r['segundos']:>10.3f}{r['pico_mb']:>14.1f}{r['rss_mb']:>14.1f}{sum(r['pedidos'].values()):>9}  {detalhe}")
+    return "\n".join(linhas)
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark offline da app contra um Google Sheets em memória.")
+    p.add_argument("--linhas", type=int, nargs="+", default=[1_000, 100_000, 1_000_000], help="tamanhos do histórico de faturas")
+    p.add_argument("--latencia-ms", type=float, default=0.0, help="espera simulada por cada pedido à API")
+    p.add_argument("--sincrono", action="store_true", help="escritas diretas ao Sheets em vez do diário em segundo plano")
+    p.add_argument("--timeout", type=float, default=900, help="segundos máximos por execução do script")
+    p.add_argument("--saida", help="ficheiro onde guardar também o relatório")
+    args = p.parse_args()
+
+    os.chdir(PASTA)  # a app lê .streamlit/logo.png por caminho relativo
+    viaturas = constante_app("LISTA_VIATURAS")
+    latencia = args.latencia_ms / 1000
+    tracemalloc.start()
+    resultados = []
+    for n in args.linhas:
+        print(f"A medir {n} linhas...", file=sys.stderr)
+        resultados += correr_tamanho(n, viaturas, latencia, args.sincrono, args.timeout)
+    texto = relatorio(resultados, latencia)
+    print(texto)
+    if args.saida:
+        with open(args.saida, "w", encoding="utf-8") as f: f.write(texto + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""Backends de faturas contra o Google Sheets em memória do benchmark.py: conflitos de versão,
+escritas repetidas depois de um timeout e o rollup incremental da cache.
+
+    python -m pytest -q
+"""
+import os
+import sys
+import threading
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # corre o script em modo bare (só o ecrã de login), como num import normal
+import benchmark
+
+def fatura(nf, id_fatura, valor="10,00", data="2025-03-01", matricula="06-QO-19", categoria="Oficina", versao="1"):
+    return [data, matricula, categoria, valor, "1000", nf, "", "", "", "", id_fatura, versao]
+
+def dados(linha, **mudancas):
+    """As colunas A:G que o editor envia, com mudancas (ex.: valor="20,00")."""
+    return fatura(linha[5], linha[10], **{"valor": linha[3], "data": linha[0], "matricula": linha[1], "categoria": linha[2], **mudancas})[:7]
+
+def falhar_depois(monkeypatch, folha, metodo, vezes=1):
+    """O pedido chega ao Google (a folha muda) mas a resposta perde-se: as primeiras `vezes` dão timeout."""
+    original, feitas = getattr(folha, metodo), []
+    def _metodo(*a, **k):
+        resultado = original(*a, **k)
+        if len(feitas) < vezes:
+            feitas.append(1)
+            raise TimeoutError("timeout depois de aplicar")
+        return resultado
+    monkeypatch.setattr(folha, metodo, _metodo)
+
+@pytest.fixture
+def livro(monkeypatch):
+    contador = benchmark.ContadorPedidos()
+    livro = benchmark.LivroFalso([benchmark.FolhaFalsa("Faturas", [list(app.COLUNAS_FATURAS)], contador),
+                                  benchmark.FolhaFalsa("Validades", [list(app.COLUNAS_VALIDADES)], contador)], contador)
+    benchmark.instalar(livro, contador)
+    monkeypatch.setattr(app, "ler_credenciais", lambda: {"type": "service_account"})
+    app.obter_ligacao().reiniciar()
+    return livro
+
+@pytest.fixture
+def sinc(livro, tmp_path):
+    """SQLite com a fila de sincronização, a folha de destino e a FolhaFalsa por trás dela."""
+    return app.BackendSQLite(str(tmp_path / "frota.db")), app.BackendSheets(), livro.folhas[0]
+
+# --- 1. CONFLITOS DE VERSÃO ---
+def test_sheets_recusa_editar_ou_apagar_versao_antiga(livro):
+    folha = livro.folhas[0]
+    folha.linhas.append(fatura("A1", "a1"))
+    backend = app.BackendSheets()
+    with pytest.raises(app.ConflitoFatura): backend.editar_faturas([("a1", 0, 0, dados(folha.linhas[1], valor="20,00"))])
+    with pytest.raises(app.ConflitoFatura): backend.eliminar_fatura("a1", 0, 0)
+    assert folha.linhas[1] == fatura("A1", "a1")
+    backend.editar_faturas([("a1", 1, 0, dados(folha.linhas[1], valor="20,00"))])
+    assert folha.linhas[1][3] == "20,00" and folha.linhas[1][11] == "2"
+
+def test_sqlite_recusa_editar_ou_apagar_versao_antiga(tmp_path):
+    backend = app.BackendSQLite(str(tmp_path / "frota.db"), sincronizar=False)
+    backend.inserir_faturas([fatura("A1", "a1")])
+    with pytest.raises(app.ConflitoFatura): backend.editar_faturas([("a1", 0, 0, dados(fatura("A1", "a1"), valor="20,00"))])
+    with pytest.raises(app.ConflitoFatura): backend.eliminar_fatura("a1", 0, 0)
+    backend.editar_faturas([("a1", 1, 0, dados(fatura("A1", "a1"), valor="20,00"))])
+    assert backend._ler_df()[["Valor", "Versao"]].values.tolist() == [["20,00", "2"]]
+
+# --- 2. ESCRITAS REPETIDAS (o Google aplicou, a resposta não chegou) ---
+def test_insercao_repetida_nao_duplica(sinc, monkeypatch):
+    base, destino, folha = sinc
+    base.inserir_faturas([fatura("N1", "n1")])
+    falhar_depois(monkeypatch, folha, "append_rows")
+    with pytest.raises(TimeoutError): base.sincronizar_sheets(destino)
+    base.sincronizar_sheets(destino)
+    assert [l[5] for l in folha.linhas[1:]] == ["N1"]
+    assert base.pendentes_sinc() == 0
+
+def test_edicao_repetida_ja_aplicada_nao_da_conflito(sinc, monkeypatch):
+    base, destino, folha = sinc
+    base.inserir_faturas([fatura("N1", "n1")])
+    base.sincronizar_sheets(destino)
+    base.editar_faturas([("n1", 1, 0, dados(fatura("N1", "n1"), valor="20,00"))])
+    falhar_depois(monkeypatch, folha, "batch_update", vezes=2)  # executar tenta duas vezes
+    with pytest.raises(TimeoutError): base.sincronizar_sheets(destino)
+    base.sincronizar_sheets(destino)
+    assert folha.linhas[1][3] == "20,00" and folha.linhas[1][11] == "2"
+    assert base.pendentes_sinc() == 0 and base.conflitos_sinc() == (0, "")  # sem conflito nem folha reescrita
+
+def test_apagamento_repetido_ja_feito_conta_como_feito(sinc, monkeypatch):
+    base, destino, folha = sinc
+    base.inserir_faturas([fatura("N1", "n1"), fatura("N2", "n2")])
+    base.sincronizar_sheets(destino)
+    base.eliminar_fatura("n1", 1, 0)
+    falhar_depois(monkeypatch, folha, "delete_rows")
+    with pytest.raises(TimeoutError): base.sincronizar_sheets(destino)
+    base.sincronizar_sheets(destino)
+    assert [l[5] for l in folha.linhas[1:]] == ["N2"]
+    assert base.pendentes_sinc() == 0 and base.conflitos_sinc() == (0, "")
+
+# --- 3. CACHE E ROLLUP INCREMENTAIS ---
+def test_rollup_incremental_igual_ao_completo():
+    linhas = [fatura(f"R{i}", f"r{i}", valor=f"{10 + i},50", data=f"2025-{1 + i % 3:02d}-10", matricula=["06-QO-19", "59-RT-87"][i % 2],
+                     categoria=["Oficina", "Pneus"][i % 2]) for i in range(8)]
+    cache = app.CacheFaturas()
+    cache.guardar(app._normalizar_faturas([app.COLUNAS_FATURAS] + linhas))
+    cache.tipadas, cache.versao_tipadas = app.tipar_faturas(cache.df), cache.versao
+    cache.rollup = app.RollupMensal(cache.tipadas)
+
+    cache.acrescentar([fatura("R8", "r8", valor="99,00", data="2025-04-01")])
+    cache.editar_linhas([(1, dados(linhas[1], valor="1,00", categoria="Oficina"))])
+    cache.eliminar_linha(2)
+    cache.editar_linhas([(0, dados(linhas[0], data="2024-12-31"))])
+
+    assert cache.versao_tipadas == cache.versao  # as tipadas acompanharam sem se recalcular tudo
+    completo = app.tipar_faturas(cache.df)
+    pd.testing.assert_frame_equal(cache.tipadas.sort_index(), completo, check_dtype=False)
+    pd.testing.assert_frame_equal(cache.rollup.tabela.sort_index(), app.RollupMensal.agregar(completo).sort_index(), check_dtype=False)
+
+def test_refrescar_nao_tranca_a_cache_durante_a_leitura(livro, monkeypatch):
+    folha = livro.folhas[0]
+    folha.linhas.append(fatura("A1", "a1"))
+    cache = app.CacheFaturas()
+    cache.guardar(app._normalizar_faturas([list(app.COLUNAS_FATURAS)] + folha.linhas[1:]))
+    cache.carregado_em = cache.sinc_total_em = 0.0  # TTL acabado, vai ler a folha toda
+    monkeypatch.setattr(app, "obter_diario", lambda: None)
+    monkeypatch.setattr(app, "obter_cache_faturas", lambda: cache)
+    a_ler, continuar, original = threading.Event(), threading.Event(), folha.get_all_values
+    def _lenta(*a, **k):
+        valores = original(*a, **k)
+        a_ler.set(); continuar.wait(5)
+        return valores
+    monkeypatch.setattr(folha, "get_all_values", _lenta)
+    fio = threading.Thread(target=app.carregar_faturas_tipadas)
+    fio.start()
+    assert a_ler.wait(5)
+    livre = cache.lock.acquire(timeout=1)  # outra sessão usa a cache enquanto esta espera pelo Google
+    if livre:
+        folha.linhas.append(fatura("A2", "a2"))
+        cache.acrescentar([fatura("A2", "a2")])  # gravada a meio: a leitura já feita não a tem
+        cache.lock.release()
+    continuar.set()
+    fio.join(5)
+    assert livre and cache.df["Num_Fatura"].tolist() == ["A1", "A2"]
+
+# --- 4. TELEMETRIA ---
+def test_falha_fora_do_gspread_fica_registada_uma_vez(monkeypatch):
+    import sqlite3
+    telemetria = app.obter_telemetria()
+    def _falhar(): raise sqlite3.OperationalError("database is locked")
+    monkeypatch.setattr(app.obter_backend(), "ler_validades", _falhar)
+    monkeypatch.setattr(app, "_validades_expiradas", lambda cache: True)
+    antes = len(telemetria.erros)
+    assert app.carregar_validades().empty
+    novos = list(telemetria.erros)[antes:]
+    assert [(e["onde"], e["erro"]) for e in novos] == [("dados.validades", "OperationalError")]